@@ -3,25 +3,72 @@
 import sys
 import os
 import concurrent.futures
+import threading
 import time
 
-from utils import config, logger, env, args
+from utils import config, logger, env, args, limits, bandwidth, DB_PATH
 from media.movieFolder import MovieFolder
+from media.probeCache import ProbeCache
+from media.nfoCache import NfoCache
+from media.classifier import Classifier
+from media.libraryWalker import LibraryWalker
+from media.folderState import FolderState, TRAILER_PRESENT, DOWNLOADED, UNAVAILABLE, NO_MOVIE
+from media.missingTrailers import MissingTrailers, NO_LINKS, DEAD_LINKS, DOWNLOAD_FAILED
 from providers.tmdb import Tmdb
+from providers.tmdbCache import TmdbCache
+from providers.tmdbIndex import TmdbIndex
 from providers.apple import Apple
+from providers.appleCache import AppleCache
+from providers.radarr import Radarr
+from downloaders import is_staging_file
 from downloaders.downloader import Downloader
+from downloaders.linkValidator import LinkValidator
+from utils.watcher import LibraryWatcher
+from utils.httpClient import create_session
+from utils.rateLimiter import RateLimiter
+from utils.pipeline import Pipeline, Stage
 
 log = logger.get_log('TrailerTech')
 
+class TrailerJob():
+    '''
+    State of one movie directory as it moves through the scan, lookup and download stages
+    '''
+    def __init__(self, movieDir, tmdbid=None, imdbid=None, title=None, year=None):
+        self.movieDir = os.path.abspath(movieDir)
+        self.tmdbid = tmdbid
+        self.imdbid = imdbid
+        self.title = title
+        self.year = year
+        self.folder = None
+        self.movieId = None
+        self.links = []
+        self.outcome = None
+
 class TrailerTech():
     def __init__(self):
         self.directoriesScanned = 0
         self.trailersDownloaded = []
         self.trailersFound = 0
+        self._statsLock = threading.Lock()
         self.startTime = time.perf_counter()
-        self.tmdb = Tmdb(config.min_resolution, config.max_resolution, config.languages, config.tmdb_API_key)
-        self.apple = Apple(config.min_resolution, config.max_resolution)
-        self.downloader = Downloader()
+        self.session = create_session(max(config.pool_size, limits.maxLookups + limits.maxDownloads), config.retries, config.retry_backoff)
+        self.tmdbCache = TmdbCache(DB_PATH, config.tmdb_cache_ttl * 86400)
+        self.tmdbIndex = TmdbIndex(DB_PATH)
+        self.tmdbLimiter = RateLimiter(config.tmdb_rate_limit)
+        self.tmdb = Tmdb(config.min_resolution, config.max_resolution, config.languages, config.tmdb_API_key,
+                         self.tmdbCache, self.session, self.tmdbLimiter, self.tmdbIndex)
+        self.appleCache = AppleCache(DB_PATH, config.apple_cache_ttl * 86400)
+        self.apple = Apple(config.min_resolution, config.max_resolution, self.session, self.appleCache)
+        self.probeCache = ProbeCache(DB_PATH, config.probe_cache_size)
+        self.nfoCache = NfoCache(DB_PATH, config.nfo_cache_size)
+        self.radarr = Radarr(config.radarr_url, config.radarr_api_key, self.session)
+        self.downloader = Downloader(self.session, config.download_segments, self.probeCache)
+        self.linkValidator = LinkValidator(config.validate_links, self.session)
+        self.classifier = Classifier()
+        self.folderState = FolderState(DB_PATH)
+        self.walker = LibraryWalker(config.library_max_depth, config.library_exclude)
+        self.missingTrailers = MissingTrailers(DB_PATH)
 
     def printStats(self):
         secondsElapsed = time.perf_counter() - self.startTime
@@ -29,10 +76,30 @@ class TrailerTech():
         statsStr = '''
            TrailerTech Stats:
            Movie Directories Scanned: {}
+           Unchanged Dirs Skipped:    {}
            Trailers Downloaded:       {}
            Missing Trailers:          {}
+           Known Missing Skipped:     {}
+           Videos Classified/Probed:  {}/{}
+           Probe Cache Hits/Misses:   {}/{}
+           NFO Cache Hits/Misses:     {}/{}
+           TMDB Cache Hits/Misses:    {}/{}
+           TMDB Index Hits/Misses:    {}/{}
+           TMDB Rate Limited:         {}
+           Apple Cache Hits/Misses:   {}/{}
+           Apple Cache Revalidated:   {}
+           Apple Location Hits/Miss:  {}/{}
+           Links Checked/Dropped:     {}/{}
+           Probe/Lookup/DL Limits:    {}
+           Bandwidth Limit:           {}
            Completed In:              {}s
-        '''.format(self.directoriesScanned, len(self.trailersDownloaded), missingTrailers, int(secondsElapsed))
+        '''.format(self.directoriesScanned, self.folderState.skipped, len(self.trailersDownloaded), missingTrailers, self.missingTrailers.skipped,
+                   self.classifier.classified, self.classifier.probed,
+                   self.probeCache.hits, self.probeCache.misses, self.nfoCache.hits, self.nfoCache.misses,
+                   self.tmdbCache.hits, self.tmdbCache.misses, self.tmdbIndex.hits, self.tmdbIndex.misses, self.tmdbLimiter.throttled,
+                   self.appleCache.hits, self.appleCache.misses, self.appleCache.revalidated,
+                   self.appleCache.locationHits, self.appleCache.locationMisses,
+                   self.linkValidator.checked, self.linkValidator.dropped, limits, bandwidth, int(secondsElapsed))
         if len(self.trailersDownloaded) > 0:
             statsStr += '\nNew Trailers:\n'
         for trailer in self.trailersDownloaded:
@@ -40,44 +107,84 @@ class TrailerTech():
         
         print(statsStr)
 
+    def pruneCaches(self):
+        self.probeCache.prune()
+        self.nfoCache.prune()
+        self.tmdbCache.prune()
+        self.appleCache.prune()
+
     def get_Trailer(self, movieDir, tmdbid=None, imdbid=None, title=None, year=None):
-        links = []
         # Check for invalid directory
         if not os.path.isdir(os.path.abspath(movieDir)):
             log.warning('Skipping. Invalid path: {}'.format(movieDir))
             return
 
+        outcome = self._getTrailer(movieDir, tmdbid, imdbid, title, year)
+        self.folderState.record(os.path.abspath(movieDir), outcome)
+
+    def _getTrailer(self, movieDir, tmdbid=None, imdbid=None, title=None, year=None):
+        job = TrailerJob(movieDir, tmdbid, imdbid, title, year)
+        for stage in (self._scanStage, self._lookupStage, self._validateStage, self._downloadStage):
+            stage(job)
+            if job.outcome:
+                return job.outcome
+
+    def _scanStage(self, job):
         # Parse movie folder. skip if no movies found
-        folder = MovieFolder(movieDir, deleteCorruptTrailer=args.deleteCorrupt)
+        folder = MovieFolder(job.movieDir, deleteCorruptTrailer=args.deleteCorrupt, probeCache=self.probeCache, classifier=self.classifier, nfoCache=self.nfoCache)
+        self.downloader.removeStale([path for path in folder.hiddenFiles if is_staging_file(os.path.basename(path))])
         if not folder.hasMovie:
-            log.warning('Skipping. Unable to determine Movie file in: {}'.format(movieDir))
+            log.warning('Skipping. Unable to determine Movie file in: {}'.format(job.movieDir))
+            job.outcome = NO_MOVIE
             return
 
-        self.directoriesScanned += 1
+        with self._statsLock:
+            self.directoriesScanned += 1
         
         # skip if trailer already exists
         if folder.hasTrailer:
             log.debug('Skipping. Local trailer found: {}'.format(folder.trailer.path))
-            self.trailersFound += 1
+            with self._statsLock:
+                self.trailersFound += 1
+            job.outcome = TRAILER_PRESENT
             return
 
+        job.folder = folder
+
+    def _lookupStage(self, job):
+        folder = job.folder
+        links = []
+
         # If user provided data parse that info
-        if (tmdbid or imdbid) or (title and year):
-            if self.tmdb.get_movie_details(tmdbid, imdbid, title, year):
-                if config.apple_enabled:
-                    links.extend(self.apple.getLinks(self.tmdb.title, self.tmdb.year))
-                if config.youtube_enabled:
-                    links.extend(self.tmdb.getLinks())
-            else:
+        if (job.tmdbid or job.imdbid) or (job.title and job.year):
+            movie = self.tmdb.lookup(job.tmdbid, job.imdbid, job.title, job.year)
+            if not movie:
+                job.outcome = UNAVAILABLE
                 return
+            job.title, job.year = movie.title, movie.year
         
         # Otherwise use movie folder data
         else:
-            if config.apple_enabled:
-                links.extend(self.apple.getLinks(folder.title, folder.year))
-            if config.youtube_enabled:
-                if self.tmdb.get_movie_details(folder.tmdb, folder.imdb, folder.title, folder.year):
-                    links.extend(self.tmdb.getLinks())
+            movie = self.tmdb.lookup(folder.tmdb, folder.imdb, folder.title, folder.year)
+            job.title, job.year = folder.title, folder.year
+
+        # remember resolved ids in the folder so later scans go straight to the details
+        if movie and not folder.tmdb and (config.write_sidecar or config.write_nfo_ids):
+            folder.saveIds(movie.tmdbid, movie.imdbid, config.write_sidecar, config.write_nfo_ids)
+
+        # skip movies that recently had no usable trailer
+        job.movieId = movie.tmdbid if movie else None
+        if job.movieId:
+            if args.recheck:
+                self.missingTrailers.clear(job.movieId)
+            elif self.missingTrailers.shouldSkip(job.movieId):
+                job.outcome = UNAVAILABLE
+                return
+
+        if config.apple_enabled:
+            links.extend(self.apple.getLinks(job.title, job.year))
+        if config.youtube_enabled and movie:
+            links.extend(movie.links)
 
         # sort by source; reverse=True = prefer youtube-dl
         links.sort(reverse=config.perferred_source == 'youtube', key=lambda link: link['source'])
@@ -90,13 +197,36 @@ class TrailerTech():
         for link in links:
             log.debug('Source: {}, Size: {}, link: {}'.format(link['source'], link['height'], link['url']))
 
+        job.links = links
+        if not links:
+            self._trailerUnavailable(job, NO_LINKS)
+
+    def _validateStage(self, job):
+        # drop dead candidates before spending a download attempt on them
+        job.links = self.linkValidator.validate(job.links)
+        if not job.links:
+            log.info('All trailer links for "{}" ({}) are unavailable'.format(job.folder.title, job.folder.year))
+            self._trailerUnavailable(job, DEAD_LINKS)
+
+    def _downloadStage(self, job):
+        folder = job.folder
+
         # send them to the downloader
-        for link in links:
+        for link in job.links:
             if self.downloader.download(folder.trailerName, folder.trailerDirectory, link['url']):
                 self.trailersDownloaded.append(folder.trailerName)
+                if job.movieId:
+                    self.missingTrailers.clear(job.movieId)
+                job.outcome = DOWNLOADED
                 return
         
-        log.info('No local or downloadable trailers for "{}" ({})'.format(folder.title, folder.year))
+        self._trailerUnavailable(job, DOWNLOAD_FAILED)
+
+    def _trailerUnavailable(self, job, reason):
+        log.info('No local or downloadable trailers for "{}" ({})'.format(job.folder.title, job.folder.year))
+        if job.movieId:
+            self.missingTrailers.record(job.movieId, job.title, job.year, reason)
+        job.outcome = UNAVAILABLE
 
     def scanLibrary(self, directory):
         libraryDir = os.path.abspath(directory)
@@ -104,11 +234,9 @@ class TrailerTech():
             log.critical('"{}" is not a valid path. Exiting.'.format(libraryDir))
             return
 
-        for item in os.listdir(libraryDir):
-            path = os.path.abspath(os.path.join(libraryDir, item))
-            if os.path.isdir(path):
-                log.info('Scanning: {}'.format(path))
-                self.get_Trailer(path)
+        for path in self.walker.walk(libraryDir, self._skipUnchanged()):
+            log.info('Scanning: {}'.format(path))
+            self.get_Trailer(path)
 
     def scanLibraryThreaded(self, directory):
         libraryDir = os.path.abspath(directory)
@@ -116,21 +244,129 @@ class TrailerTech():
             log.critical('"{}" is not a valid path. Exiting.'.format(libraryDir))
             return
         log.info('Building list of directories to scan for trailers.')
-        movieDirs = [os.path.join(libraryDir, subDir) for subDir in os.listdir(libraryDir) if os.path.isdir(os.path.join(libraryDir, subDir))]
+        movieDirs = list(self.walker.walk(libraryDir, self._skipUnchanged()))
         log.info('Initiating scan on {} movie directories.'.format(len(movieDirs)))
-        with concurrent.futures.ThreadPoolExecutor(max_workers=None) as executer:
+        log.info('Concurrency limits (probes/lookups/downloads): {}'.format(limits))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=config.pool_size) as executer:
             executer.map(self.get_Trailer, movieDirs)
 
+    def scanLibraryPipeline(self, directory):
+        libraryDir = os.path.abspath(directory)
+        if not os.path.isdir(libraryDir):
+            log.critical('"{}" is not a valid path. Exiting.'.format(libraryDir))
+            return
+
+        self._runPipeline(self._discoverJobs(libraryDir))
+
+    def _runPipeline(self, jobs):
+        # Stage workers match the process wide limits. Unlimited stages fall back to the pool size
+        workers = [limit if limit > 0 else config.pool_size for limit in (limits.maxProbes, limits.maxLookups, limits.maxDownloads)]
+        pipeline = Pipeline([
+            Stage('scan', self._pipelineStage(self._scanStage), workers[0]),
+            Stage('lookup', self._pipelineStage(self._lookupStage), workers[1]),
+            Stage('validate', self._pipelineStage(self._validateStage), workers[1]),
+            Stage('download', self._pipelineStage(self._downloadStage), workers[2])
+        ])
+        log.info('Initiating pipeline scan. Scan workers: {} Lookup workers: {} Download workers: {}'.format(*workers))
+        pipeline.run(jobs)
+
+    def _discoverJobs(self, libraryDir):
+        for path in self.walker.walk(libraryDir, self._skipUnchanged()):
+            log.info('Scanning: {}'.format(path))
+            yield TrailerJob(path)
+
+    def _skipUnchanged(self):
+        # Unchanged movie folders are skipped before the walker lists them
+        return None if args.full else self.folderState.isUnchanged
+
+    def scanRadarr(self):
+        if not self.radarr.configured:
+            log.critical('Radarr url and api_key must be set in settings.ini to scan Radarr. Exiting.')
+            return
+
+        # Radarr already knows every id, so no folder names are parsed and no searches are made
+        jobs = []
+        for movie in self.radarr.getMovies():
+            path = os.path.abspath(movie.path)
+            if not os.path.isdir(path):
+                log.warning('Skipping. Radarr path not found: {}'.format(movie.path))
+                continue
+            if not args.full and self.folderState.isUnchanged(path):
+                continue
+            jobs.append(TrailerJob(path, movie.tmdbid, movie.imdbid, movie.title, movie.year))
+        log.info('Initiating scan on {} movies from Radarr.'.format(len(jobs)))
+
+        if args.pipeline:
+            self._runPipeline(jobs)
+        elif args.threads:
+            log.info('Concurrency limits (probes/lookups/downloads): {}'.format(limits))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=config.pool_size) as executer:
+                executer.map(lambda job: self.get_Trailer(job.movieDir, job.tmdbid, job.imdbid, job.title, job.year), jobs)
+        else:
+            for job in jobs:
+                log.info('Scanning: {}'.format(job.movieDir))
+                self.get_Trailer(job.movieDir, job.tmdbid, job.imdbid, job.title, job.year)
+
+    def _pipelineStage(self, stage):
+        # Finished jobs are recorded and dropped, the rest move on to the next stage
+        def run(job):
+            stage(job)
+            if job.outcome:
+                self.folderState.record(job.movieDir, job.outcome)
+                return None
+            return job
+        return run
+
+    def watchLibrary(self, directory):
+        libraryDir = os.path.abspath(directory)
+        if not os.path.isdir(libraryDir):
+            log.critical('"{}" is not a valid path. Exiting.'.format(libraryDir))
+            return
+
+        watcher = LibraryWatcher(libraryDir, self.walker, config.watch_debounce, config.watch_poll_interval, args.poll or config.watch_use_polling)
+        watcher.run(lambda directory: self._onDirectoryChanged(libraryDir, directory))
+
+    def _onDirectoryChanged(self, libraryDir, directory):
+        # Our own downloads change the directory too. Those are recorded as unchanged.
+        # The changed directory may be a movie folder or a collection of them
+        for movieDir in self.walker.walk(libraryDir, self.folderState.isUnchanged, top=directory):
+            log.info('Scanning: {}'.format(movieDir))
+            self.get_Trailer(movieDir)
+        self.pruneCaches()
+
     def main(self):
         log.info('Starting TrailerTech')
         if not self.tmdb.hasAPIkey:
             log.critical('No TMDB API key was found, try adding one to settings.ini Aborting all operations.')
             sys.exit(0)
+
+        if args.rebuildProbeCache:
+            self.probeCache.clear()
+
+        if not args.rebuildTmdbIndex is None:
+            self.tmdbIndex.rebuild(args.rebuildTmdbIndex, self.session)
+            if not args.directory and not args.radarr and not env.event:
+                return
+
+        # Remove leftovers of the old shared download directory
+        self.downloader.cleanUp()
+
         # Check if any args were parsed from user
-        if args.directory:
-            if args.recursive:
+        if args.radarr:
+            log.info('Parsing movies from Radarr at {}'.format(self.radarr.url))
+            self.scanRadarr()
+            self.pruneCaches()
+
+        elif args.directory:
+            if args.watch:
+                log.info('Watching "{}" for new movies.'.format(args.directory))
+                self.watchLibrary(args.directory)
+            elif args.recursive:
                 # Parse entire library
-                if args.threads:
+                if args.pipeline:
+                    log.info('Parsing "{}" in recursive mode. Pipeline enabled.'.format(args.directory))
+                    self.scanLibraryPipeline(args.directory)
+                elif args.threads:
                     log.info('Parsing "{}" in recursive mode. Threads enabled.'.format(args.directory))
                     self.scanLibraryThreaded(args.directory)
                 else:
@@ -141,18 +377,14 @@ class TrailerTech():
                 log.info('Parsing "{}" in single movie mode.'.format(args.directory))
                 self.get_Trailer(args.directory, args.tmdb, args.imdb, args.title, args.year)
 
-            # Cleanup the temp download directory
-            log.info('Cleaning up temp directory.')
-            self.downloader.cleanUp()
+            self.pruneCaches()
 
         # Check environment variables
         elif env.event == 'download' and env.movieDirectory:
             log.info('Called from Radarr Parsing "{}"'.format(env.movieDirectory))
             self.get_Trailer(env.movieDirectory, env.tmdbid, env.imdbid, env.movieTitle, env.year)
 
-            # Cleanup the temp download directory
-            log.info('Cleaning up temp directory.')
-            self.downloader.cleanUp()
+            self.pruneCaches()
 
         elif env.event == 'test':
             log.info('Radarr called with event: {}'.format(env.event))
@@ -1,5 +1,27 @@
 #!/usr/bin/env python3
 
 import os
+import hashlib
 
-DL_DIRECTORY = os.path.join(os.path.dirname(__file__), 'downloads')
\ No newline at end of file
+DL_DIRECTORY = os.path.join(os.path.dirname(__file__), 'downloads')
+STAGING_TAG = '.ttpart'
+STALE_AGE = 3600  # In seconds. Younger staging files may belong to a download still in progress
+RESUME_AGE = 604800  # In seconds. How long partial downloads with resume state are kept
+
+def staging_prefix(fileName, link=None):
+    # Every link gets its own staging files so a partial download survives attempts at other links
+    root = os.path.splitext(fileName)[0]
+    if link is None:
+        return '.{}{}'.format(root, STAGING_TAG)
+    return '.{}{}-{}'.format(root, STAGING_TAG, hashlib.sha1(link.encode('utf-8')).hexdigest()[:8])
+
+def staging_path(destinationDirectory, fileName, link=None):
+    # Hidden file next to the destination so the final move is an atomic rename on the same filesystem
+    ext = os.path.splitext(fileName)[1]
+    return os.path.join(destinationDirectory, staging_prefix(fileName, link) + ext)
+
+def resume_state_path(stagingPath):
+    return os.path.splitext(stagingPath)[0] + '.json'
+
+def is_staging_file(fileName):
+    return fileName.startswith('.') and STAGING_TAG in fileName
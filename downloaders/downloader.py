@@ -1,31 +1,72 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import json
+import time
 import shutil
 import yt_dlp
+import struct
 import requests
+import concurrent.futures
 
-from utils import logger
-from downloaders import DL_DIRECTORY
+from utils import logger, limits, bandwidth
+from downloaders.integrity import Checksum, inspect_container
+from downloaders import DL_DIRECTORY, STALE_AGE, RESUME_AGE, staging_path, staging_prefix, resume_state_path
+
+DOWNLOAD_ATTEMPTS = 3
+CHUNK_SIZE = 256 * 1024
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+MIN_TRAILER_SIZE = 1000000
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024  # Files are never split into ranges smaller than this
+APPLE_HEADERS = {'User-Agent': 'Quick_time/7.6.2'}
+YOUTUBE_FORMAT = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]'
 
 log = logger.get_log(__name__)
 
 class Downloader():
-    def __init__(self):
-        self._createTempDir()
+    def __init__(self, session=None, segments=1, probeCache=None):
+        self.session = session or requests.Session()
+        self.segments = max(int(segments), 1)
+        self.probeCache = probeCache
 
     def cleanUp(self):
-        for filename in os.listdir(DL_DIRECTORY):
-            file_path = os.path.join(DL_DIRECTORY, filename)
+        # Downloads used to be staged in a shared directory. Remove anything left there
+        if not os.path.isdir(DL_DIRECTORY):
+            return
+        try:
+            shutil.rmtree(DL_DIRECTORY)
+        except OSError as e:
+            log.warning('Failed to remove: {} ERROR: {}'.format(DL_DIRECTORY, e))
+            return
+        log.debug('Removed {}'.format(DL_DIRECTORY))
+
+    def removeStale(self, paths):
+        for path in paths:
+            # Partial downloads that can be resumed are kept longer than other leftovers
+            resumable = path.endswith('.json') or os.path.isfile(resume_state_path(path))
             try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
+                if time.time() - os.path.getmtime(path) < (RESUME_AGE if resumable else STALE_AGE):
+                    continue
+                os.remove(path)
             except OSError as e:
-                log.warning('Failed to remove: {} ERROR: {}'.format(filename, e))
+                log.warning('Failed to remove stale partial download: {} ERROR: {}'.format(path, e))
                 continue
-            log.debug('Removed {}'.format(file_path))
+            log.info('Removed stale partial download {}'.format(path))
+
+    def _discard(self, destinationDirectory, fileName, link=None):
+        # Remove the staging files of link, or of every link when None, and any intermediate files yt-dlp left next to them
+        prefix = staging_prefix(fileName, link)
+        try:
+            entries = os.listdir(destinationDirectory)
+        except OSError:
+            return
+        for entry in entries:
+            if entry.startswith(prefix):
+                try:
+                    os.remove(os.path.join(destinationDirectory, entry))
+                except OSError as e:
+                    log.warning('Failed to remove: {} ERROR: {}'.format(entry, e))
 
     def _moveTo(self, source, destination):
         log.info('Download Complete Moving {} to {}'.format(os.path.basename(source), os.path.dirname(destination)))
@@ -34,24 +75,45 @@ class Downloader():
             log.warning('Failed to move {} ERROR: {} does not exist.'.format(os.path.basename(source), os.path.dirname(destination)))
             return False
 
-        # attempt to move the file
+        # staging files live in the destination directory so this is an atomic rename
         try:
-            # os.replace(source, destination)
-            shutil.move(source, destination)
+            os.replace(source, destination)
         except OSError as e:
             log.warning('Failed to move {} ERROR: {}'.format(os.path.basename(source), e))
             return False
         return True
 
-    def _createTempDir(self):
-        if not os.path.isdir(DL_DIRECTORY):
-            os.mkdir(DL_DIRECTORY)
+    def _verifyAndMove(self, source, destination, checksum=None):
+        '''
+        Checks the container of a finished download before moving it into place and records the
+        result with its checksum so later scans trust the trailer without probing it
+        '''
+        try:
+            result = inspect_container(source)
+            digest = (checksum or Checksum()).hexdigest(source)
+        except (OSError, ValueError, struct.error, IndexError) as e:
+            log.warning('{} failed the integrity check. ERROR: {}'.format(os.path.basename(destination), e))
+            return False
+        if not (result.video_streams and result.audio_streams):
+            log.warning('{} failed the integrity check. ERROR: Missing video or audio track'.format(os.path.basename(destination)))
+            return False
+
+        if not self._moveTo(source, destination):
+            return False
+        log.debug('Verified {} sha256: {}'.format(os.path.basename(destination), digest))
+        if self.probeCache:
+            try:
+                stat = os.stat(destination)
+            except OSError:
+                return True
+            self.probeCache.store(destination, stat.st_size, stat.st_mtime, result, digest)
+        return True
 
     def downloadYouTube(self, fileName, destinationDirectory, link):
-        tempFilePath = os.path.join(DL_DIRECTORY, fileName)
+        tempFilePath = staging_path(destinationDirectory, fileName, link)
         destinationPath = os.path.join(destinationDirectory, fileName)
         options = {
-        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]',
+        'format': YOUTUBE_FORMAT,
         'default_search': 'auto',
         'restrictfilenames': True,
         'prefer_ffmpeg': True,
@@ -61,53 +123,270 @@ class Downloader():
         'noplaylist': True,
         'noprogress': True,
         'logger': logger.get_null_log('YouTube-DL'),
-        'outtmpl': tempFilePath
+        'outtmpl': tempFilePath.replace('%', '%%')
         }
 
         log.info('Attempting to download video: {} from "{}". Please Wait...'.format(fileName, link))
         try:
-            with yt_dlp.YoutubeDL(options) as youtube:
-                youtube.extract_info(link, download=True)
+            with bandwidth.stream():
+                # yt-dlp paces itself. Give it this download's share of the budget when it starts
+                share = bandwidth.share()
+                if share:
+                    options['ratelimit'] = int(share)
+                with yt_dlp.YoutubeDL(options) as youtube:
+                    youtube.extract_info(link, download=True)
         except Exception as e:
             log.warning('Something went wrong while getting trailer from {}. ERROR: {}'.format(link, e))
+            self._discard(destinationDirectory, fileName, link)
             return False
 
-        if os.path.isfile(tempFilePath):
-            self._moveTo(tempFilePath, destinationPath)
+        if os.path.isfile(tempFilePath) and self._verifyAndMove(tempFilePath, destinationPath):
+            # Partial downloads from other links are no longer needed
+            self._discard(destinationDirectory, fileName)
             return True
         else:
             log.warning('Failed to download from {}'.format(link))
+            self._discard(destinationDirectory, fileName, link)
             return False
 
     def downloadApple(self, fileName, destinationDirectory, link):
         log.info('Attempting to download video at "{}". Please Wait...'.format(link))
-        tempPath = os.path.join(DL_DIRECTORY, fileName)
+        tempPath = staging_path(destinationDirectory, fileName, link)
         destinationPath = os.path.join(destinationDirectory, fileName)
-        headers = {'User-Agent': 'Quick_time/7.6.2'}
 
+        checksum = Checksum()
+        with bandwidth.stream() as stream:
+            result = self._fetchAppleStaged(link, tempPath, stream, checksum)
+        if not result:
+            if result is False:
+                self._discard(destinationDirectory, fileName, link)
+            else:
+                # Keep the partial file and its resume state for the next run
+                log.warning('Giving up on {} for now. The partial download will be resumed next time.'.format(link))
+            return False
+
+        if self._verifyAndMove(tempPath, destinationPath, checksum):
+            # Partial downloads from other links are no longer needed
+            self._discard(destinationDirectory, fileName)
+            return True
+        self._discard(destinationDirectory, fileName, link)
+        return False
+
+    def _fetchAppleStaged(self, link, tempPath, stream, checksum):
+        '''
+        Returns True when tempPath holds the complete file, False on permanent failures
+        and None when the download should be resumed on a later run
+        '''
+        if self.segments > 1 and not self._loadResumeState(tempPath, link):
+            result = self._fetchSegmented(link, tempPath, stream, checksum)
+            if not result is None:
+                return result
+
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            if attempt:
+                time.sleep(2 ** attempt)
+                log.info('Resuming download of {} (attempt {} of {})'.format(link, attempt + 1, DOWNLOAD_ATTEMPTS))
+            result = self._fetchApple(link, tempPath, stream, checksum)
+            if not result is None:
+                return result
+        return None
+
+    def _loadResumeState(self, tempPath, link):
+        try:
+            with open(resume_state_path(tempPath), 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if state.get('url') != link or not os.path.isfile(tempPath):
+            return None
+        return state
+
+    def _saveResumeState(self, tempPath, state):
+        try:
+            with open(resume_state_path(tempPath), 'w') as f:
+                json.dump(state, f)
+        except IOError as e:
+            log.debug('Failed to save resume state for {} ERROR: {}'.format(tempPath, e))
+
+    def _removeResumeState(self, tempPath):
         try:
-            with requests.get(link, stream=True, headers=headers, timeout=5) as response:
+            os.remove(resume_state_path(tempPath))
+        except OSError:
+            pass
+
+    def _fetchApple(self, link, tempPath, stream=None, checksum=None):
+        '''
+        Returns True when tempPath holds the complete file, False on permanent failures
+        and None on interruptions that may be resumed
+        '''
+        headers = dict(APPLE_HEADERS)
+        state = self._loadResumeState(tempPath, link)
+        offset = os.path.getsize(tempPath) if state else 0
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            validator = state.get('etag') or state.get('last_modified')
+            if validator:
+                headers['If-Range'] = validator
+
+        try:
+            with self.session.get(link, stream=True, headers=headers, timeout=5) as response:
+                if response.status_code == 416 and state and offset == state.get('length'):
+                    return True
                 response.raise_for_status()
-                if int(response.headers.get('Content-length')) < 1000000:
-                    log.warning('File too small. URL: {} Content-Length: {}'.format(link, response.headers.get('Content-Length')))
-                    return False
-                with open(tempPath, 'wb') as tempFile:
-                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+
+                if response.status_code == 206:
+                    match = CONTENT_RANGE_PATTERN.match(response.headers.get('Content-Range', ''))
+                    if not match or int(match.group(1)) != offset:
+                        log.warning('Unexpected Content-Range from {}. Restarting download.'.format(link))
+                        self._removeResumeState(tempPath)
+                        return None
+                    log.info('Resuming {} from byte {}'.format(os.path.basename(tempPath), offset))
+                    total = int(match.group(2)) if match.group(2) != '*' else offset + int(response.headers.get('Content-Length', 0))
+                    mode = 'ab'
+                else:
+                    # Server ignored the range or the file changed. Start over
+                    total = int(response.headers.get('Content-Length', 0))
+                    if total < MIN_TRAILER_SIZE:
+                        log.warning('File too small. URL: {} Content-Length: {}'.format(link, response.headers.get('Content-Length')))
+                        return False
+                    mode = 'wb'
+                    self._saveResumeState(tempPath, {
+                        'url': link,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                        'length': total
+                    })
+
+                position = offset if mode == 'ab' else 0
+                with open(tempPath, mode) as tempFile:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
                         tempFile.write(chunk)
+                        if checksum:
+                            checksum.update(position, chunk)
+                        position += len(chunk)
+                        if stream:
+                            stream.throttle(len(chunk))
 
         except requests.exceptions.HTTPError as e:
             log.warning('Encountered an HTTP error while downloading from: {} ERROR: {}'.format(link, e))
             return False
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            log.warning('Download of {} was interrupted. ERROR: {}'.format(link, e))
+            return None
         except IOError as e:
             log.warning('Encountered an error while writing to disk. File: {} ERROR: {}'.format(tempPath, e))
             return False
 
-        if self._moveTo(tempPath, destinationPath):
-            self.cleanUp()
-            return True
+        size = os.path.getsize(tempPath)
+        if total and size < total:
+            log.warning('Download of {} ended early. Received {} of {} bytes'.format(link, size, total))
+            return None
+        if total and size > total:
+            log.warning('Download of {} is larger than expected. Received {} of {} bytes'.format(link, size, total))
+            return False
+        return True
+
+    def _fetchSegmented(self, link, tempPath, stream=None, checksum=None):
+        '''
+        Downloads link as parallel byte ranges into a preallocated tempPath. Returns True when
+        tempPath holds the complete file, False on permanent failures and None when a single
+        stream should be used instead
+        '''
+        try:
+            with self.session.head(link, headers=APPLE_HEADERS, allow_redirects=True, timeout=5) as response:
+                response.raise_for_status()
+                headers = response.headers
+        except requests.exceptions.RequestException as e:
+            log.debug('Range probe of {} failed. Using a single stream. ERROR: {}'.format(link, e))
+            return None
+
+        length = int(headers.get('Content-Length', 0) or 0)
+        if headers.get('Accept-Ranges', '').lower() != 'bytes' or length < MIN_SEGMENT_SIZE * 2:
+            log.debug('{} does not support ranged downloads. Using a single stream.'.format(link))
+            return None
+
+        # The first segment uses the slot held by download(). Extra segments only use free slots
+        wanted = min(self.segments, length // MIN_SEGMENT_SIZE)
+        extra = limits.acquireDownloads(wanted - 1)
+        try:
+            if not extra:
+                log.debug('No free download slots for a segmented download of {}. Using a single stream.'.format(link))
+                return None
+            count = extra + 1
+            size = -(-length // count)
+            ranges = [(start, min(start + size, length) - 1) for start in range(0, length, size)]
+            validator = headers.get('ETag') or headers.get('Last-Modified')
+
+            try:
+                with open(tempPath, 'wb') as tempFile:
+                    tempFile.truncate(length)
+            except IOError as e:
+                log.warning('Encountered an error while writing to disk. File: {} ERROR: {}'.format(tempPath, e))
+                return False
+
+            log.info('Downloading {} in {} segments'.format(os.path.basename(tempPath), len(ranges)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix='segment') as executor:
+                received = list(executor.map(lambda r: self._fetchRange(link, tempPath, r[0], r[1], validator, stream, checksum), ranges))
+        finally:
+            limits.releaseDownloads(extra)
+
+        if sum(received) != length or os.path.getsize(tempPath) != length:
+            log.warning('Segmented download of {} is incomplete. Received {} of {} bytes. Retrying as a single stream.'.format(link, sum(received), length))
+            try:
+                os.remove(tempPath)
+            except OSError:
+                pass
+            return None
+        return True
+
+    def _fetchRange(self, link, tempPath, start, end, validator=None, stream=None, checksum=None):
+        '''
+        Writes bytes start to end of link into tempPath at the same offset and returns the
+        number of bytes written
+        '''
+        written = 0
+        expected = end - start + 1
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            if attempt:
+                time.sleep(2 ** attempt)
+            offset = start + written
+            headers = dict(APPLE_HEADERS, Range='bytes={}-{}'.format(offset, end))
+            if validator:
+                headers['If-Range'] = validator
+            try:
+                with self.session.get(link, stream=True, headers=headers, timeout=5) as response:
+                    response.raise_for_status()
+                    match = CONTENT_RANGE_PATTERN.match(response.headers.get('Content-Range', ''))
+                    if response.status_code != 206 or not match or int(match.group(1)) != offset:
+                        # The file changed or the server ignored the range
+                        log.warning('Unexpected response to a range request for {}'.format(link))
+                        return written
+                    with open(tempPath, 'r+b') as tempFile:
+                        tempFile.seek(offset)
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            chunk = chunk[:expected - written]
+                            tempFile.write(chunk)
+                            if checksum:
+                                checksum.update(start + written, chunk)
+                            written += len(chunk)
+                            if stream:
+                                stream.throttle(len(chunk))
+            except requests.exceptions.HTTPError as e:
+                log.warning('Encountered an HTTP error while downloading from: {} ERROR: {}'.format(link, e))
+                return written
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                log.debug('Segment {}-{} of {} was interrupted. ERROR: {}'.format(start, end, link, e))
+                continue
+            except IOError as e:
+                log.warning('Encountered an error while writing to disk. File: {} ERROR: {}'.format(tempPath, e))
+                return written
+            if written >= expected:
+                break
+        return written
 
     def download(self, fileName, destinationDirectory, link):
-        if 'apple' in link.lower():
-            return self.downloadApple(fileName, destinationDirectory, link)
-        elif 'youtube' in link.lower() or 'vimeo' in link.lower():
-            return self.downloadYouTube(fileName, destinationDirectory, link)
+        with limits.downloads:
+            if 'apple' in link.lower():
+                return self.downloadApple(fileName, destinationDirectory, link)
+            elif 'youtube' in link.lower() or 'vimeo' in link.lower():
+                return self.downloadYouTube(fileName, destinationDirectory, link)
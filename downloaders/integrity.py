@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import struct
+import hashlib
+import threading
+from media.probeCache import ProbeResult
+
+HASH_BLOCK_SIZE = 1024 * 1024
+MAX_MOOV_SIZE = 64 * 1024 * 1024  # Larger movie headers are not read into memory
+# Old QuickTime files may start with one of these instead of ftyp
+QUICKTIME_ATOMS = {b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot', b'uuid'}
+
+class Checksum():
+    '''
+    sha256 of a file built from the bytes as they are written. When bytes arrive out of
+    order, e.g. resumed or segmented downloads, the file is read back once instead.
+    '''
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def update(self, offset, data):
+        with self._lock:
+            if self._hash is None:
+                return
+            if offset != self._offset:
+                self._hash = None
+                return
+            self._hash.update(data)
+            self._offset += len(data)
+
+    def hexdigest(self, path):
+        with self._lock:
+            if not self._hash is None and self._offset == os.path.getsize(path):
+                return self._hash.hexdigest()
+        return file_checksum(path)
+
+def file_checksum(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def _atoms(f, start, end):
+    # Yields (type, dataStart, atomEnd) for the atoms between start and end. Raises ValueError on truncation
+    position = start
+    while position < end:
+        if end - position < 8:
+            raise ValueError('Trailing bytes after last atom')
+        f.seek(position)
+        size, kind = struct.unpack('>I4s', f.read(8))
+        headerSize = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            headerSize = 16
+        elif size == 0:
+            size = end - position
+        if size < headerSize or position + size > end:
+            raise ValueError('Atom "{}" is truncated'.format(kind.decode('latin-1')))
+        yield kind, position + headerSize, position + size
+        position += size
+
+def _children(f, start, end, kind):
+    return [atom for atom in _atoms(f, start, end) if atom[0] == kind]
+
+def inspect_container(path):
+    '''
+    Walks the atoms of an MP4/QuickTime file and returns a ProbeResult read from its movie
+    header. Raises ValueError when the container is truncated or malformed.
+    '''
+    with open(path, 'rb') as f:
+        f.seek(4)
+        first = f.read(4)
+        if not (first == b'ftyp' or first in QUICKTIME_ATOMS):
+            raise ValueError('Not an MP4 or QuickTime file')
+        atoms = list(_atoms(f, 0, os.fstat(f.fileno()).st_size))
+        moov = [atom for atom in atoms if atom[0] == b'moov']
+        if not moov or not any(atom[0] == b'mdat' for atom in atoms):
+            raise ValueError('Missing moov or mdat atom')
+
+        _, start, end = moov[0]
+        if end - start > MAX_MOOV_SIZE:
+            raise ValueError('moov atom is too large')
+        f.seek(start)
+        header = io.BytesIO(f.read(end - start))
+
+    duration = None
+    for _, start, _ in _children(header, 0, len(header.getbuffer()), b'mvhd'):
+        header.seek(start)
+        version = header.read(1)[0]
+        header.seek(start + (20 if version == 1 else 12))
+        timescale, length = struct.unpack('>IQ' if version == 1 else '>II', header.read(12 if version == 1 else 8))
+        if timescale:
+            duration = length / timescale
+
+    videoStreams = audioStreams = 0
+    width = height = None
+    for _, trakStart, trakEnd in _children(header, 0, len(header.getbuffer()), b'trak'):
+        handler = None
+        for _, mdiaStart, mdiaEnd in _children(header, trakStart, trakEnd, b'mdia'):
+            for _, start, _ in _children(header, mdiaStart, mdiaEnd, b'hdlr'):
+                header.seek(start + 8)
+                handler = header.read(4)
+        if handler == b'vide':
+            videoStreams += 1
+            for _, start, end in _children(header, trakStart, trakEnd, b'tkhd'):
+                if width is None and end - start >= 8:
+                    header.seek(end - 8)
+                    trackWidth, trackHeight = struct.unpack('>II', header.read(8))
+                    width, height = trackWidth >> 16, trackHeight >> 16
+        elif handler == b'soun':
+            audioStreams += 1
+
+    return ProbeResult(duration, videoStreams, audioStreams, width, height, False)
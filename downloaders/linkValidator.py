@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import threading
+import concurrent.futures
+import yt_dlp
+import requests
+
+from utils import logger, limits
+from downloaders.downloader import APPLE_HEADERS, CONTENT_RANGE_PATTERN, MIN_TRAILER_SIZE, YOUTUBE_FORMAT
+
+log = logger.get_log(__name__)
+
+class LinkValidator():
+    '''
+    Checks the best candidate links concurrently so dead links never cost a download attempt.
+    A count of 0 or less disables validation.
+    '''
+    def __init__(self, count=3, session=None):
+        self.count = int(count)
+        self.session = session or requests.Session()
+        self.checked = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def validate(self, links):
+        '''
+        Returns links without the dead ones among the first count candidates.
+        Order is preserved and links beyond count are kept unchecked as fallbacks.
+        '''
+        candidates = links[:self.count] if self.count > 0 else []
+        if not candidates:
+            return links
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix='validate') as executor:
+            alive = list(executor.map(self.isAlive, [link['url'] for link in candidates]))
+
+        live = [link for link, ok in zip(candidates, alive) if ok]
+        with self._lock:
+            self.checked += len(candidates)
+            self.dropped += len(candidates) - len(live)
+        return live + links[len(candidates):]
+
+    def isAlive(self, url):
+        if 'apple' in url.lower():
+            return self._checkApple(url)
+        elif 'youtube' in url.lower() or 'vimeo' in url.lower():
+            return self._checkYouTube(url)
+        return True
+
+    def _checkApple(self, url):
+        try:
+            with limits.lookups:
+                with self.session.head(url, headers=APPLE_HEADERS, allow_redirects=True, timeout=5) as response:
+                    status = response.status_code
+                    length = int(response.headers.get('Content-Length', 0) or 0)
+                # Some servers refuse HEAD. Ask for the first byte instead and read the total size
+                if status in (405, 501):
+                    headers = dict(APPLE_HEADERS, Range='bytes=0-0')
+                    with self.session.get(url, headers=headers, stream=True, timeout=5) as response:
+                        status = response.status_code
+                        match = CONTENT_RANGE_PATTERN.match(response.headers.get('Content-Range', ''))
+                        if match and match.group(2) != '*':
+                            length = int(match.group(2))
+                        else:
+                            length = int(response.headers.get('Content-Length', 0) or 0)
+        except requests.exceptions.RequestException as e:
+            log.debug('Dropping unreachable link {} ERROR: {}'.format(url, e))
+            return False
+
+        if status >= 400:
+            log.debug('Dropping dead link {} Status: {}'.format(url, status))
+            return False
+        if length < MIN_TRAILER_SIZE:
+            log.debug('Dropping link {} Content-Length: {}'.format(url, length))
+            return False
+        return True
+
+    def _checkYouTube(self, url):
+        options = {
+            'format': YOUTUBE_FORMAT,
+            'quiet': True,
+            'no_warnings': True,
+            'noplaylist': True,
+            'noprogress': True,
+            'logger': logger.get_null_log('YouTube-DL')
+        }
+        try:
+            with limits.lookups, yt_dlp.YoutubeDL(options) as youtube:
+                info = youtube.extract_info(url, download=False, process=True)
+        except Exception as e:
+            log.debug('Dropping unavailable link {} ERROR: {}'.format(url, e))
+            return False
+        return bool(info)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import threading
+from utils import logger
+
+MOVIE = 'movie'
+TRAILER = 'trailer'
+EXTRA = 'extra'
+
+MIN_MOVIE_SIZE = 300000000  # In bytes. Smaller files are never assumed to be the movie without probing
+MOVIE_SIZE_RATIO = 4  # The movie must be this many times larger than the next largest video
+DISC_IMAGE_EXTENSIONS = ['.iso', '.img']
+TRAILER_PATTERN = re.compile(r'-trailer\d*$', flags=re.IGNORECASE)
+EXTRA_PATTERN = re.compile(r'-(behindthescenes|deleted|featurette|interview|scene|short|other)\d*$', flags=re.IGNORECASE)
+SAMPLE_PATTERN = re.compile(r'(^|[-_. \[(])sample($|[-_. \])])', flags=re.IGNORECASE)
+
+log = logger.get_log(__name__)
+
+class Classifier():
+    '''
+    Decides which videos in a folder are the movie, trailers or extras from names and sizes alone.
+    Videos that can not be decided this way are left for ffprobe.
+    '''
+    def __init__(self):
+        self.classified = 0
+        self.probed = 0
+        self._lock = threading.Lock()
+
+    def _count(self, classified, probed):
+        with self._lock:
+            self.classified += classified
+            self.probed += probed
+
+    def classify(self, directory, videos):
+        '''
+        videos: list of (path, size) tuples for the video files in directory
+        returns: dict of path to MOVIE, TRAILER, EXTRA or None when ffprobe is needed
+        '''
+        results = {}
+        candidates = []
+        folderName = os.path.basename(os.path.abspath(directory)).lower()
+
+        for path, size in videos:
+            stem, ext = os.path.splitext(os.path.basename(path))
+            if TRAILER_PATTERN.search(stem):
+                results[path] = TRAILER
+            elif EXTRA_PATTERN.search(stem):
+                results[path] = EXTRA
+            elif SAMPLE_PATTERN.search(stem) and size < MIN_MOVIE_SIZE:
+                results[path] = EXTRA
+            elif ext.lower() in DISC_IMAGE_EXTENSIONS:
+                results[path] = MOVIE
+            else:
+                candidates.append((path, size, stem.lower()))
+
+        movie = None
+        if not MOVIE in results.values() and candidates:
+            candidates.sort(key=lambda candidate: candidate[1], reverse=True)
+            path, size, stem = candidates[0]
+            if size >= MIN_MOVIE_SIZE:
+                if len(candidates) == 1:
+                    movie = path
+                elif size >= candidates[1][1] * MOVIE_SIZE_RATIO:
+                    movie = path
+                elif stem.startswith(folderName) and not any(c[2].startswith(folderName) for c in candidates[1:]):
+                    # Radarr names the movie after its folder "Title (Year)"
+                    movie = path
+
+        for path, size, stem in candidates:
+            if movie:
+                results[path] = MOVIE if path == movie else EXTRA
+            elif MOVIE in results.values():
+                results[path] = EXTRA
+            else:
+                results[path] = None
+
+        ambiguous = len([result for result in results.values() if result is None])
+        self._count(len(results) - ambiguous, ambiguous)
+        log.debug('Classified {} of {} videos in "{}" without probing'.format(len(results) - ambiguous, len(results), directory))
+        return results
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import hashlib
+from utils import logger
+from utils.database import Database
+from media.movieFolder import DISC_INDEX_FILES
+
+TRAILER_PRESENT = 'trailer'
+DOWNLOADED = 'downloaded'
+UNAVAILABLE = 'unavailable'
+NO_MOVIE = 'no_movie'
+COMPLETE_OUTCOMES = [TRAILER_PRESENT, DOWNLOADED]
+
+log = logger.get_log(__name__)
+
+class FolderState(Database):
+    '''
+    Remembers the fingerprint and outcome of every scanned movie directory so
+    unchanged directories that already have a trailer can be skipped.
+    BDMV and VIDEO_TS folders hold the trailers of disc movies, so their mtime and
+    listing count as part of the movie directory.
+    '''
+    NAME = 'folder_state'
+    VERSION = 2
+    TABLES = {
+        'folders': '''CREATE TABLE IF NOT EXISTS folders (
+            path TEXT PRIMARY KEY,
+            mtime REAL NOT NULL,
+            fingerprint TEXT NOT NULL,
+            discs TEXT NOT NULL,
+            outcome TEXT NOT NULL,
+            updated REAL NOT NULL)'''
+    }
+    COUNTERS = ('skipped',)
+
+    def fingerprint(self, directory):
+        return self._scan(directory)[0]
+
+    def _scan(self, directory):
+        # Returns the fingerprint of directory and the names of the disc folders inside it
+        entries = []
+        discs = []
+        try:
+            for entry in os.scandir(directory):
+                if entry.is_dir():
+                    entries.append('{}/'.format(entry.name))
+                    if entry.name.lower() in DISC_INDEX_FILES:
+                        discs.append(entry.name)
+                        entries.extend(self._listDisc(entry.path, entry.name))
+                else:
+                    entries.append('{}:{}'.format(entry.name, entry.stat().st_size))
+        except OSError as e:
+            log.debug('Unable to fingerprint {} ERROR: {}'.format(directory, e))
+            return None, discs
+        return hashlib.sha1('\n'.join(sorted(entries)).encode('utf-8', 'surrogateescape')).hexdigest(), sorted(discs)
+
+    def _listDisc(self, discDir, name):
+        # Only the top level of a disc folder holds trailers. Its stream folders are never listed
+        entries = []
+        for entry in os.scandir(discDir):
+            if entry.is_dir():
+                entries.append('{}/{}/'.format(name, entry.name))
+            else:
+                entries.append('{}/{}:{}'.format(name, entry.name, entry.stat().st_size))
+        return entries
+
+    def _mtime(self, directory, discs):
+        # Adding a trailer to a disc folder leaves the movie directory mtime untouched
+        return max(os.stat(path).st_mtime for path in [directory] + [os.path.join(directory, disc) for disc in discs])
+
+    def isUnchanged(self, directory):
+        rows = self.execute('SELECT * FROM folders WHERE path = ?', (directory,))
+        if not rows or not rows[0]['outcome'] in COMPLETE_OUTCOMES:
+            return False
+        row = rows[0]
+
+        try:
+            mtime = self._mtime(directory, row['discs'].split('/') if row['discs'] else [])
+        except OSError:
+            return False
+
+        if mtime != row['mtime']:
+            # Directory was touched. Only its contents tell us if anything really changed
+            if self.fingerprint(directory) != row['fingerprint']:
+                return False
+            self.execute('UPDATE folders SET mtime = ? WHERE path = ?', (mtime, directory))
+
+        self._count('skipped')
+        log.debug('Skipping. Unchanged since last scan: {}'.format(directory))
+        return True
+
+    def record(self, directory, outcome):
+        fingerprint, discs = self._scan(directory)
+        try:
+            mtime = self._mtime(directory, discs)
+        except OSError:
+            return
+        if fingerprint is None:
+            return
+        self.execute(
+            'INSERT OR REPLACE INTO folders (path, mtime, fingerprint, discs, outcome, updated) VALUES (?, ?, ?, ?, ?, ?)',
+            (directory, mtime, fingerprint, '/'.join(discs), outcome, time.time())
+        )
+
+    def forget(self, directory):
+        self.execute('DELETE FROM folders WHERE path = ?', (directory,))
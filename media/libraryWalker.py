@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import os
+from fnmatch import fnmatch
+from utils import logger
+from media.movieFolder import VIDEO_EXTENSIONS
+
+DISC_FOLDERS = ('bdmv', 'video_ts')
+
+log = logger.get_log(__name__)
+
+class LibraryWalker():
+    '''
+    Finds movie folders at any depth up to maxDepth below a library, e.g. collections or A-Z
+    buckets. A folder holding a video or a disc structure is a movie folder and is not descended.
+    Only the DirEntry types returned by scandir are used, so no file below a movie folder is
+    ever stat'ed. Names or relative paths matching an exclude glob are never entered.
+    '''
+    def __init__(self, maxDepth=3, exclude=None):
+        self.maxDepth = max(int(maxDepth), 1)
+        self.exclude = [pattern.strip() for pattern in (exclude or []) if pattern.strip()]
+
+    def walk(self, root, skip=None, top=None):
+        '''
+        Yields movie folder paths below root. Folders for which skip(path) is True are not listed.
+        With top, only the part of the tree below that folder is walked and top itself is yielded
+        when it is a movie folder. Depth and excludes are still measured from root.
+        '''
+        root = os.path.abspath(root)
+        top = os.path.abspath(top or root)
+        depth = self._depth(root, top)
+        if depth is None:
+            return
+
+        stack = [(top, depth)]
+        while stack:
+            path, depth = stack.pop()
+            # The library root itself is never a movie folder
+            if path != root and skip and skip(path):
+                continue
+            isMovie, subdirs = self._list(path, root)
+            if isMovie and path != root:
+                yield path
+            elif depth < self.maxDepth:
+                stack.extend((subdir, depth + 1) for subdir in reversed(subdirs))
+
+    def directories(self, root, top=None):
+        '''
+        Yields root and every folder walk would list below it, i.e. the folders it descends and
+        the movie folders it finds. With top, only the part of the tree below that folder is yielded.
+        '''
+        root = os.path.abspath(root)
+        top = os.path.abspath(top or root)
+        depth = self._depth(root, top)
+        if depth is None:
+            return
+
+        stack = [(top, depth)]
+        while stack:
+            path, depth = stack.pop()
+            yield path
+            isMovie, subdirs = self._list(path, root)
+            if not isMovie and depth < self.maxDepth:
+                stack.extend((subdir, depth + 1) for subdir in reversed(subdirs))
+
+    def _depth(self, root, top):
+        # Returns the depth of top below root or None when a walk from root never lists it
+        if top == root:
+            return 0
+        relative = os.path.relpath(top, root)
+        if relative.startswith(os.pardir) or any(part.startswith('.') for part in relative.split(os.sep)):
+            return None
+        if self._isExcluded(top, root):
+            return None
+        depth = relative.count(os.sep) + 1
+        return depth if depth <= self.maxDepth else None
+
+    def _isExcluded(self, path, root):
+        name = os.path.basename(path)
+        relative = os.path.relpath(path, root)
+        return any(fnmatch(name, pattern) or fnmatch(relative, pattern) for pattern in self.exclude)
+
+    def _list(self, directory, root):
+        # Returns whether directory is a movie folder and its subdirectories in name order
+        isMovie = False
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.') or self._isExcluded(entry.path, root):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            if entry.name.lower() in DISC_FOLDERS:
+                                isMovie = True
+                            else:
+                                subdirs.append(entry.path)
+                        elif not isMovie and os.path.splitext(entry.name)[-1].lower() in VIDEO_EXTENSIONS and entry.is_file():
+                            isMovie = True
+                    except OSError:
+                        continue
+        except OSError as e:
+            log.warning('Unable to list {} ERROR: {}'.format(directory, e))
+        return isMovie, sorted(subdirs)
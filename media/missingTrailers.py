@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import time
+from utils import logger
+from utils.database import Database
+
+NO_LINKS = 'no_links'
+DEAD_LINKS = 'dead_links'
+DOWNLOAD_FAILED = 'download_failed'
+BACKOFF_DAYS = [1, 3, 7, 30]
+
+log = logger.get_log(__name__)
+
+class MissingTrailers(Database):
+    '''
+    Remembers movies without a usable trailer and when they are due for another attempt.
+    Each consecutive failure moves the next attempt further out following BACKOFF_DAYS.
+    '''
+    NAME = 'missing_trailers'
+    VERSION = 1
+    TABLES = {
+        'missing': '''CREATE TABLE IF NOT EXISTS missing (
+            tmdbid INTEGER PRIMARY KEY,
+            title TEXT,
+            year TEXT,
+            reason TEXT NOT NULL,
+            failures INTEGER NOT NULL,
+            last_checked REAL NOT NULL,
+            next_check REAL NOT NULL)'''
+    }
+    COUNTERS = ('skipped',)
+
+    def shouldSkip(self, tmdbid):
+        rows = self.execute('SELECT * FROM missing WHERE tmdbid = ?', (int(tmdbid),))
+        if not rows or rows[0]['next_check'] <= time.time():
+            return False
+
+        row = rows[0]
+        log.info('Skipping. No trailer for "{}" ({}) after {} attempts ({}). Next attempt after {}'.format(
+            row['title'], row['year'], row['failures'], row['reason'], time.strftime('%Y-%m-%d %H:%M', time.localtime(row['next_check']))
+        ))
+        self._count('skipped')
+        return True
+
+    def record(self, tmdbid, title, year, reason):
+        with self._lock:
+            rows = self.execute('SELECT failures FROM missing WHERE tmdbid = ?', (int(tmdbid),))
+            failures = rows[0]['failures'] + 1 if rows else 1
+            delay = BACKOFF_DAYS[min(failures, len(BACKOFF_DAYS)) - 1] * 86400
+            now = time.time()
+            self.execute(
+                'INSERT OR REPLACE INTO missing (tmdbid, title, year, reason, failures, last_checked, next_check) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (int(tmdbid), title, year, reason, failures, now, now + delay)
+            )
+        log.debug('Recorded missing trailer for "{}" ({}) reason: {} attempts: {}'.format(title, year, reason, failures))
+
+    def clear(self, tmdbid):
+        self.execute('DELETE FROM missing WHERE tmdbid = ?', (int(tmdbid),))
@@ -5,7 +5,10 @@ import json
 import subprocess
 import re
 from datetime import datetime
-from utils import logger
+from utils import logger, limits
+from media.probeCache import ProbeResult
+from media.classifier import Classifier, MOVIE, TRAILER, TRAILER_PATTERN
+from downloaders.integrity import file_checksum
 try:
     import xml.etree.cElementTree as et
 except ImportError:
@@ -15,6 +18,10 @@ MIN_MOVIE_DURATION = 600  # In seconds
 MIN_TRAILER_SIZE = 500000  # In bytes
 VIDEO_EXTENSIONS = ['.mkv', '.iso', '.wmv', '.avi', '.mp4', '.m4v', '.img', '.divx', '.mov', '.flv', '.m2ts', '.ts']
 NFO_EXTENSIONS = ['.nfo', '.xml']
+DISC_INDEX_FILES = {'bdmv': 'index.bdmv', 'video_ts': 'VIDEO_TS.IFO'}  # Disc folder name to the file standing in for the movie
+DISC_INDEX_NAMES = [name.lower() for name in DISC_INDEX_FILES.values()]
+SIDECAR_NAME = '.trailertech.json'  # Ids resolved by earlier runs
+MOVIE_NFO_ROOTS = ['movie', 'title']  # Kodi and MediaBrowser
 ID_TAGS = ['imdb', 'tmdb', 'imdbid', 'tmdbid', 'tmdb_id', 'imdb_id', 'id']
 IMDB_ID_PATTERN = re.compile(r'ev\d{7,8}\/\d{4}(-\d)?|(ch|co|ev|nm|tt)\d{7,8}', flags=re.IGNORECASE)
 TMDB_ID_PATTERN = re.compile(r'[1-9]\d{1,10}')
@@ -22,6 +29,20 @@ YEAR_PATTERN = re.compile(r'\d{4}')
 
 log = logger.get_log(__name__)
 
+def write_atomic(path, data):
+    # Write to a hidden file first so readers on other machines never see a partial file
+    tempPath = os.path.join(os.path.dirname(path), '.{}.tmp'.format(os.path.basename(path).lstrip('.')))
+    try:
+        with open(tempPath, 'wb') as f:
+            f.write(data)
+        os.replace(tempPath, path)
+    except OSError:
+        try:
+            os.remove(tempPath)
+        except OSError:
+            pass
+        raise
+
 class File():
     def __init__(self, path):
         self.path = path
@@ -41,8 +62,10 @@ class File():
             pass
 
 class Video(File):
-    def __init__(self, path):
+    def __init__(self, path, probeCache=None):
         super().__init__(path)
+        self.probeCache = probeCache
+        self._probe = None
 
     @property
     def isCorrupt(self):
@@ -54,29 +77,27 @@ class Video(File):
         if self.fileSize < MIN_TRAILER_SIZE:
             return True
 
-        result = subprocess.run([
-            'ffprobe', '-v', 'fatal', '-print_format', 
-            'json', '-show_format', '-show_streams', '-show_error',
-            self.path],
-            stdout=subprocess.PIPE
-            )
-
-        videoDetails = json.loads(result.stdout.decode())
-        returnCode = result.returncode
-        if returnCode != 0:
+        probe = self.probe()
+        if probe.error:
             return True
-        if videoDetails.get('error'):
+
+        if probe.video_streams > 0 and probe.audio_streams > 0:
+            return not self._matchesChecksum()
+        else:
             return True
-        if not videoDetails.get('streams'):
+
+    def _matchesChecksum(self):
+        # Trailers verified while downloading are never probed, so their recorded checksum is the only way to notice later damage
+        checksum = self.probeCache.getChecksum(self.path) if self.probeCache else None
+        if not checksum:
             return True
-        
-        video_streams = [item for item in videoDetails['streams'] if item['codec_type'] == 'video']
-        audio_streams = [item for item in videoDetails['streams'] if item['codec_type'] == 'audio']
-        
-        if len(video_streams) > 0 and len(audio_streams) > 0:
+        try:
+            matches = file_checksum(self.path) == checksum
+        except OSError:
             return False
-        else:
-            return True
+        if not matches:
+            log.warning('{} no longer matches the checksum recorded when it was downloaded'.format(self.fileName))
+        return matches
 
     @property
     def isMovie(self):
@@ -94,36 +115,73 @@ class Video(File):
             # Unable to determine duration assume its the movie since it doesn't have -trailer in file name
             return True
 
+    @property
+    def resolution(self):
+        return self.probe().height
+
     def get_duration(self):
-        result = subprocess.run([
-            'ffprobe', '-v', 'fatal', '-show_entries',
-            'format=duration', '-of',
-            'default=noprint_wrappers=1:nokey=1',
-            self.path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
-            )
+        return self.probe().duration
+
+    def probe(self):
+        if self._probe:
+            return self._probe
+
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            stat = None
+
+        if self.probeCache and stat:
+            self._probe = self.probeCache.get(self.path, stat.st_size, stat.st_mtime)
+            if self._probe:
+                return self._probe
+
+        self._probe = self._runProbe()
+        if self.probeCache and stat:
+            self.probeCache.store(self.path, stat.st_size, stat.st_mtime, self._probe)
+        return self._probe
+
+    def _runProbe(self):
+        with limits.probes:
+            result = subprocess.run([
+                'ffprobe', '-v', 'fatal', '-print_format',
+                'json', '-show_format', '-show_streams', '-show_error',
+                self.path],
+                stdout=subprocess.PIPE
+                )
+
         try:
-            return float(result.stdout)
+            videoDetails = json.loads(result.stdout.decode())
         except ValueError:
-            return None
+            videoDetails = {}
+
+        try:
+            duration = float(videoDetails.get('format', {}).get('duration'))
+        except (TypeError, ValueError):
+            duration = None
+
+        streams = videoDetails.get('streams', [])
+        video_streams = [item for item in streams if item.get('codec_type') == 'video']
+        audio_streams = [item for item in streams if item.get('codec_type') == 'audio']
+        width = video_streams[0].get('width') if video_streams else None
+        height = video_streams[0].get('height') if video_streams else None
+        error = result.returncode != 0 or bool(videoDetails.get('error')) or not streams
+
+        return ProbeResult(duration, len(video_streams), len(audio_streams), width, height, error)
 
 class NFO(File):
-    def __init__(self, path):
+    def __init__(self, path, cache=None, stat=None):
         super().__init__(path)
-        self.__originaltitle = None
-        self.__title = None
-        self.__localtitle = None
-        self.__year = None
-        self.__releasedate = None
-        self.__premiered = None
-        self.__productionyear = None
-        self.__imdb = None
-        self.__tmdb = None
-        self.__unique_id_imdb = None
-        self.__unique_id_tmdb = None
-        self.__id = None
-        self.__parse_nfo()
+        self.cache = cache
+        self._stat = stat
+        self.__fields = {}
+        self.__load()
+
+    @property
+    def fileSize(self):
+        if self._stat:
+            return self._stat.st_size
+        return super().fileSize
 
     @property
     def is_complete(self):
@@ -136,99 +194,144 @@ class NFO(File):
 
     @property
     def title(self):
-        if isinstance(self.__originaltitle, str):
-            return self.__originaltitle
-        elif isinstance(self.__title, str):
-            return self.__title
-        elif isinstance(self.__localtitle, str):
-            return self.__localtitle
-        else:
-            return None
+        for field in ['originaltitle', 'title', 'localtitle']:
+            if isinstance(self.__fields.get(field), str):
+                return self.__fields[field]
+        return None
 
     @property
     def year(self):
-        if self.__premiered:
-            year = self.__parse_releaseDate(self.__premiered)
-            match = re.match(YEAR_PATTERN, year)
-            if match:
-                return year
-        
-        if self.__releasedate:
-            year = self.__parse_releaseDate(self.__parse_releaseDate)
-            match = re.match(YEAR_PATTERN, year)
-            if match:
+        # premiered and release_date are stored as years already
+        for field in ['premiered', 'releasedate', 'year', 'productionyear']:
+            year = self.__fields.get(field)
+            if year and re.match(YEAR_PATTERN, year):
                 return year
-        
-        if self.__year:
-            match = re.match(YEAR_PATTERN, self.__year)
-            if match:
-                return self.__year
-
-        if self.__productionyear:
-            match = re.match(YEAR_PATTERN, self.__productionyear)
-            if match:
-                return self.__productionyear
-
         return None
 
     @property
     def imdb(self):
-        if self.__unique_id_imdb and re.match(IMDB_ID_PATTERN, self.__unique_id_imdb):
-            return self.__unique_id_imdb
-        if self.__imdb and re.match(IMDB_ID_PATTERN, self.__imdb):
-            return self.__imdb
-        if self.__id and re.match(IMDB_ID_PATTERN, self.__id):
-            return self.__id
+        for field in ['unique_id_imdb', 'imdb']:
+            value = self.__fields.get(field)
+            if value and re.match(IMDB_ID_PATTERN, value):
+                return value
         return None
 
     @property
     def tmdb(self):
-        if self.__unique_id_tmdb and re.match(TMDB_ID_PATTERN, self.__unique_id_tmdb):
-            return self.__unique_id_tmdb
-        if self.__tmdb and re.match(TMDB_ID_PATTERN, self.__tmdb):
-            return self.__tmdb
-        if self.__id and re.match(TMDB_ID_PATTERN, self.__id):
-            return self.__id
+        for field in ['unique_id_tmdb', 'tmdb']:
+            value = self.__fields.get(field)
+            if value and re.match(TMDB_ID_PATTERN, value):
+                return value
         return None
 
-    def __parse_nfo(self):
+    def addUniqueIds(self, tmdbid=None, imdbid=None):
+        '''
+        Adds <uniqueid> elements for ids missing from a movie NFO. Returns True when the file was changed
+        '''
         try:
-            nfo = et.parse(self.path)
-            root  = nfo.getroot()
+            tree = et.parse(self.path)
         except (IOError, et.ParseError) as e:
-            log.debug('Failed to parse NFO: {} ERROR: {}'.format(self.fileName, e))
-            return
+            log.debug('Not adding ids to {} ERROR: {}'.format(self.fileName, e))
+            return False
+
+        root = tree.getroot()
+        if root.tag.lower() != 'movie':
+            return False
+        existing = [item.attrib.get('type', '').lower() for item in root if item.tag.lower() == 'uniqueid']
+        added = False
+        for idType, value in (('tmdb', tmdbid), ('imdb', imdbid)):
+            if value and not idType in existing:
+                element = et.SubElement(root, 'uniqueid', type=idType)
+                element.text = str(value)
+                added = True
+        if not added:
+            return False
 
+        try:
+            write_atomic(self.path, et.tostring(root, encoding='UTF-8', xml_declaration=True))
+        except OSError as e:
+            log.warning('Failed to add ids to {} ERROR: {}'.format(self.fileName, e))
+            return False
+        log.info('Added TMDB/IMDB ids to {}'.format(self.fileName))
+        return True
 
-        for item in root:
-            # Parse uniqueid
-            if item.tag.lower() == 'uniqueid':
-                if item.attrib['type'].lower() == 'tmdb':
-                    self.__unique_id_tmdb = item.text
-                elif item.attrib['type'].lower() == 'imdb':
-                    self.__unique_id_imdb = item.text
-            
-            # Parse additional ids
-            elif item.tag.lower() in ID_TAGS:
-                self.__parse_id(item.text)
-            
-            # Parse release years
-            elif item.tag.lower() == 'premiered':
-                self.__premiered = self.__parse_releaseDate(item.text)
-            elif item.tag.lower() == 'release_date':
-                self.__releasedate = self.__parse_releaseDate(item.text)
-            elif item.tag.lower() == 'year':
-                self.__year = item.text
-            elif item.tag.lower() == 'productionyear':
-                self.__productionyear = item.text
-
-            # Parse titles
-            elif item.tag.lower() == 'title':
-                self.__title = item.text
-            elif item.tag.lower() == 'originaltitle':
-                self.__originaltitle = item.text
-            elif item.tag.lower() == 'localtitle':
-                self.__localtitle = item.text
+    def __load(self):
+        try:
+            stat = self._stat or os.stat(self.path)
+        except OSError:
+            stat = None
+
+        if self.cache and stat:
+            fields = self.cache.get(self.path, stat.st_size, stat.st_mtime)
+            if not fields is None:
+                self.__fields = fields
+                return
+
+        self.__fields = self.__parse_nfo()
+        if self.cache and stat:
+            self.cache.store(self.path, stat.st_size, stat.st_mtime, self.__fields)
+
+    def __parse_nfo(self):
+        # Read incrementally and stop as soon as every field we use is known. Cast and fileinfo come last in Kodi NFOs
+        fields = {}
+        root = None
+        depth = 0
+        try:
+            with open(self.path, 'rb') as f:
+                for event, element in et.iterparse(f, events=('start', 'end')):
+                    if event == 'start':
+                        depth += 1
+                        if depth == 1:
+                            root = element
+                            if not element.tag.lower() in MOVIE_NFO_ROOTS:
+                                log.debug('Skipping {}. Not a movie NFO'.format(self.fileName))
+                                return {}
+                        continue
+
+                    depth -= 1
+                    if depth == 1:
+                        self.__parse_element(fields, element)
+                        root.clear()
+                        if self.__has_all(fields):
+                            break
+        except (IOError, et.ParseError) as e:
+            # Kodi allows a URL after the XML. Keep whatever was read before the error
+            log.debug('Failed to parse NFO: {} ERROR: {}'.format(self.fileName, e))
+        return fields
+
+    def __parse_element(self, fields, item):
+        tag = item.tag.lower()
+        # Parse uniqueid
+        if tag == 'uniqueid':
+            if item.attrib.get('type', '').lower() == 'tmdb':
+                fields['unique_id_tmdb'] = item.text
+            elif item.attrib.get('type', '').lower() == 'imdb':
+                fields['unique_id_imdb'] = item.text
+
+        # Parse additional ids
+        elif tag in ID_TAGS:
+            self.__parse_id(fields, item.text)
+
+        # Parse release years
+        elif tag == 'premiered':
+            fields['premiered'] = self.__parse_releaseDate(item.text)
+        elif tag == 'release_date':
+            fields['releasedate'] = self.__parse_releaseDate(item.text)
+        elif tag == 'year':
+            fields['year'] = item.text
+        elif tag == 'productionyear':
+            fields['productionyear'] = item.text
+
+        # Parse titles
+        elif tag in ['title', 'originaltitle', 'localtitle']:
+            fields[tag] = item.text
+
+    def __has_all(self, fields):
+        hasTitle = any(fields.get(field) for field in ['originaltitle', 'title', 'localtitle'])
+        hasYear = any(fields.get(field) for field in ['premiered', 'releasedate', 'year', 'productionyear'])
+        hasTmdb = fields.get('unique_id_tmdb') or fields.get('tmdb')
+        hasImdb = fields.get('unique_id_imdb') or fields.get('imdb')
+        return bool(hasTitle and hasYear and hasTmdb and hasImdb)
 
     def __parse_releaseDate(self, releaseDate):
         if releaseDate:
@@ -242,21 +345,26 @@ class NFO(File):
         else:
             return None
 
-    def __parse_id(self, movie_id):
+    def __parse_id(self, fields, movie_id):
         if movie_id:
             if movie_id.lower().startswith('tt'):
-                self.__imdb = movie_id
+                fields['imdb'] = movie_id
             elif movie_id.isdigit():
-                self.__tmdb = movie_id
+                fields['tmdb'] = movie_id
         return None
 
 class MovieFolder():
-    def __init__(self, directory, deleteCorruptTrailer=False):
+    def __init__(self, directory, deleteCorruptTrailer=False, probeCache=None, classifier=None, nfoCache=None):
         self.deleteCorruptTrailer = deleteCorruptTrailer
+        self.probeCache = probeCache
+        self.nfoCache = nfoCache
+        self.classifier = classifier or Classifier()
         self.rootDir = os.path.abspath(directory)
         self.movie = None
         self.trailer = None
+        self.hiddenFiles = []
         self._nfo = None
+        self._sidecar = {}
         self.scan()
 
     @property
@@ -277,12 +385,16 @@ class MovieFolder():
 
     @property
     def tmdb(self):
+        if self._sidecar.get('tmdb'):
+            return str(self._sidecar['tmdb'])
         if self._nfo and self._nfo.tmdb:
             return self._nfo.tmdb
         return None
 
     @property
     def imdb(self):
+        if self._sidecar.get('imdb'):
+            return self._sidecar['imdb']
         if self._nfo and self._nfo.imdb:
             return self._nfo.imdb
         else:
@@ -307,6 +419,10 @@ class MovieFolder():
     def hasMovie(self):
         return not self.movie == None
 
+    @property
+    def _hasDiscMovie(self):
+        return self.hasMovie and self.movie.fileName.lower() in DISC_INDEX_NAMES
+
     def _parseTitleFromFolder(self):
         title = os.path.basename(self.rootDir).split('(')[0].strip()
         log.debug('Parsed title from folder: {}'.format(title)) 
@@ -330,62 +446,114 @@ class MovieFolder():
         return None
 
     def scan(self):
+        videos = []
         for item in os.scandir(self.rootDir):
-            if os.path.isfile(item.path):
+            if item.name == SIDECAR_NAME:
+                self._readSidecar(item.path)
+                continue
+
+            # Hidden files are partial downloads or OS metadata, never the movie or trailer
+            if item.name.startswith('.'):
+                self.hiddenFiles.append(item.path)
+                continue
+
+            # DirEntry types come with the listing. os.path checks would stat every entry again
+            if item.is_file():
                 ext = os.path.splitext(item.path)[-1].lower()
                 if ext in VIDEO_EXTENSIONS:
-                    video = Video(item.path)
-                    isMovie = video.isMovie
-                    if isMovie:
-                        self.movie = video
-                        log.debug('Movie Found: {}'.format(self.movie.fileName))
-                    elif isMovie == False:
-                        if self.deleteCorruptTrailer and video.isCorrupt:
-                            log.warning('Deleting corrupt trailer {}'.format(self.trailer.fileName))
-                            video.delete()
-                        else:
-                            self.trailer = video
-                            log.debug('Trailer Found: {}'.format(self.trailer.fileName))
-                    elif isMovie == None:
-                        log.warning('Could not determine if video is movie or trailer: {}'.format(video.path))
+                    videos.append((item.path, item.stat().st_size))
                 elif ext in NFO_EXTENSIONS:
-                    nfo = NFO(item.path)
+                    nfo = NFO(item.path, self.nfoCache, item.stat())
                     if (nfo.is_complete and not self._nfo) or (nfo.is_complete and nfo.fileSize > self._nfo.fileSize):
                         self._nfo = nfo
                         log.debug('NFO Found: {}'.format(self._nfo.fileName))
             
-            elif os.path.isdir(item.path):
-    
-                # Handle bdmv folders
-                if 'bdmv' in item.path.lower() and os.path.isdir(item.path):
-                    log.debug('Encountered a BluRay folder structure "{}"'.format(item.path))
-                    bd_file = os.path.join(item.path, 'index.bdmv')
-                    if os.path.isfile(bd_file):
-                        video = Video(bd_file)
-                        log.debug('Movie Found: {}'.format(video.fileName))
-                        self.movie = video
-                        # Find the trailer in the BDMV folder
-                        for entry in os.listdir(item.path):
-                            path = os.path.join(item.path, entry)
-                            if os.path.isfile(path) and os.path.splitext(path)[-1] in VIDEO_EXTENSIONS:
-                                video = Video(path)
-                                if not video.isMovie:
-                                    log.debug('Found trailer: {}'.format(video.fileName))
-                                    self.trailer = video
-                
-                # Handle video_ts folders
-                elif 'video_ts' in item.path.lower() and os.path.isdir(item.path):
-                    log.debug('Encountered a DVD folder structure "{}"'.format(item.path))
-                    dvd_file = os.path.join(item.path, 'VIDEO_TS.IFO')
-                    if os.path.isfile(dvd_file):
-                        video = Video(dvd_file)
-                        log.debug('Movie Found: {}'.format(video.fileName))
-                        self.movie = video
-                        # Find the trailer in the VIDEO_TS folder
-                        for entry in os.listdir(item.path):
-                            path = os.path.join(item.path, entry)
-                            if os.path.isfile(path) and os.path.splitext(path)[-1] in VIDEO_EXTENSIONS:
-                                video = Video(path)
-                                if not video.isMovie:
-                                    log.debug('Trailer Found: {}'.format(video.fileName))
-                                    self.trailer = video
+            elif item.is_dir():
+                # Disc backups are identified by their index file. Their stream files are never listed or probed
+                indexName = DISC_INDEX_FILES.get(item.name.lower())
+                if indexName:
+                    videos.extend(self._scanDisc(item.path, indexName))
+
+        self._scanVideos(videos)
+
+    def _readSidecar(self, path):
+        try:
+            with open(path, 'r') as f:
+                sidecar = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug('Failed to read {} ERROR: {}'.format(path, e))
+            return
+        if isinstance(sidecar, dict):
+            self._sidecar = sidecar
+            log.debug('Ids Found: {}'.format(sidecar))
+
+    def saveIds(self, tmdbid, imdbid=None, sidecar=True, nfo=False):
+        '''
+        Records resolved ids in the movie folder so later scans, from any machine, skip resolving them
+        '''
+        if sidecar:
+            path = os.path.join(self.rootDir, SIDECAR_NAME)
+            try:
+                write_atomic(path, json.dumps({'tmdb': tmdbid, 'imdb': imdbid}).encode('utf-8'))
+            except OSError as e:
+                log.warning('Failed to write {} ERROR: {}'.format(path, e))
+            else:
+                self._sidecar = {'tmdb': tmdbid, 'imdb': imdbid}
+                log.debug('Saved ids to {}'.format(path))
+
+        if nfo and self._nfo:
+            self._nfo.addUniqueIds(tmdbid, imdbid)
+
+    def _scanDisc(self, discDir, indexName):
+        '''
+        Sets the movie to the index file of a BDMV or VIDEO_TS folder and returns
+        (path, size) of the -trailer videos next to it
+        '''
+        log.debug('Encountered a disc folder structure "{}"'.format(discDir))
+        trailers = []
+        try:
+            with os.scandir(discDir) as entries:
+                for entry in entries:
+                    stem, ext = os.path.splitext(entry.name)
+                    # Downloads for disc movies are staged here
+                    if entry.name.startswith('.'):
+                        self.hiddenFiles.append(entry.path)
+                    elif entry.name.lower() == indexName.lower():
+                        if entry.is_file():
+                            self.movie = Video(entry.path)
+                            log.debug('Movie Found: {}'.format(self.movie.fileName))
+                    elif ext.lower() in VIDEO_EXTENSIONS and TRAILER_PATTERN.search(stem) and entry.is_file():
+                        trailers.append((entry.path, entry.stat().st_size))
+        except OSError as e:
+            log.warning('Unable to read disc folder {} ERROR: {}'.format(discDir, e))
+        return trailers
+
+    def _scanVideos(self, videos):
+        classified = self.classifier.classify(self.rootDir, videos)
+        for path, kind in classified.items():
+            video = Video(path, self.probeCache)
+            if kind is None:
+                isMovie = video.isMovie
+                if isMovie:
+                    kind = MOVIE
+                elif isMovie == False or self._hasDiscMovie:
+                    # Next to a disc structure any short video is a trailer
+                    kind = TRAILER
+                else:
+                    log.warning('Could not determine if video is movie or trailer: {}'.format(video.path))
+                    continue
+
+            if kind == MOVIE and self._hasDiscMovie:
+                log.debug('Ignoring {}. The movie is the disc structure'.format(video.fileName))
+            elif kind == MOVIE:
+                self.movie = video
+                log.debug('Movie Found: {}'.format(self.movie.fileName))
+            elif kind == TRAILER:
+                if self.deleteCorruptTrailer and video.isCorrupt:
+                    log.warning('Deleting corrupt trailer {}'.format(video.fileName))
+                    video.delete()
+                else:
+                    self.trailer = video
+                    log.debug('Trailer Found: {}'.format(self.trailer.fileName))
+            else:
+                log.debug('Ignoring extra: {}'.format(video.fileName))
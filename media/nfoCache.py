@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import json
+import time
+from utils import logger
+from utils.database import FileCache
+
+log = logger.get_log(__name__)
+
+class NfoCache(FileCache):
+    '''
+    Stores the fields read from NFO files keyed by path, size and mtime so unchanged NFOs are never read twice.
+    Files that are not movie NFOs are stored with no fields.
+    '''
+    NAME = 'nfo_cache'
+    VERSION = 1
+    TABLE = 'nfos'
+    TABLES = {
+        'nfos': '''CREATE TABLE IF NOT EXISTS nfos (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            fields TEXT NOT NULL,
+            last_used REAL NOT NULL)'''
+    }
+
+    def get(self, path, size, mtime):
+        row = self._getRow(path, size, mtime)
+        try:
+            fields = json.loads(row['fields']) if row else None
+        except ValueError:
+            fields = None
+        self._count('hits' if fields is not None else 'misses')
+        return fields
+
+    def store(self, path, size, mtime, fields):
+        self.execute(
+            'INSERT OR REPLACE INTO nfos (path, size, mtime, fields, last_used) VALUES (?, ?, ?, ?, ?)',
+            (path, size, mtime, json.dumps(fields), time.time())
+        )
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import time
+from collections import namedtuple
+from utils import logger
+from utils.database import FileCache
+
+ProbeResult = namedtuple('ProbeResult', ['duration', 'video_streams', 'audio_streams', 'width', 'height', 'error'])
+
+log = logger.get_log(__name__)
+
+class ProbeCache(FileCache):
+    '''
+    Stores ffprobe results keyed by path, size and mtime so unchanged files are never probed twice.
+    Trailers verified while downloading are stored with their checksum and never probed at all.
+    '''
+    NAME = 'probe_cache'
+    VERSION = 3
+    TABLE = 'probes'
+    TABLES = {
+        'probes': '''CREATE TABLE IF NOT EXISTS probes (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            duration REAL,
+            video_streams INTEGER NOT NULL,
+            audio_streams INTEGER NOT NULL,
+            width INTEGER,
+            height INTEGER,
+            error INTEGER NOT NULL,
+            checksum TEXT,
+            last_used REAL NOT NULL)'''
+    }
+
+    def get(self, path, size, mtime):
+        row = self._getRow(path, size, mtime)
+        self._count('hits' if row else 'misses')
+        if not row:
+            return None
+        return ProbeResult(row['duration'], row['video_streams'], row['audio_streams'], row['width'], row['height'], bool(row['error']))
+
+    def store(self, path, size, mtime, result, checksum=None):
+        self.execute(
+            'INSERT OR REPLACE INTO probes (path, size, mtime, duration, video_streams, audio_streams, width, height, error, checksum, last_used) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (path, size, mtime, result.duration, result.video_streams, result.audio_streams,
+             result.width, result.height, int(result.error), checksum, time.time())
+        )
+
+    def getChecksum(self, path):
+        rows = self.execute('SELECT checksum FROM probes WHERE path = ?', (path,))
+        return rows[0]['checksum'] if rows else None
+
+    def clear(self):
+        log.info('Clearing probe cache.')
+        self.execute('DELETE FROM probes')
@@ -1,19 +1,46 @@
 #!/usr/bin/env python3
 
+import json
 import requests
 import socket
-from utils import logger
+from utils import logger, limits
 
 moviePage_url = 'https://trailers.apple.com/'
 movieSearch_url = 'https://trailers.apple.com/trailers/home/scripts/quickfind.php'
 log = logger.get_log(__name__)
 
 class Apple():
-    def __init__(self, min_resolution, max_resolution):
+    def __init__(self, min_resolution, max_resolution, session=None, cache=None):
         self.min_resolution = int(min_resolution)
         self.max_resolution = int(max_resolution)
+        self.session = session or requests.Session()
+        self.cache = cache
 
     def _getMoivePage(self, title, year):
+        location = self.cache.getLocation(title, year) if self.cache else None
+        if location:
+            movieData, gone = self._getPageData(location)
+            if movieData:
+                return movieData
+            if not gone:
+                # Network trouble says nothing about the location. Keep it for the next scan
+                return False
+            # The page moved or went away. Search again
+            self.cache.forgetLocation(title, year)
+
+        location = self._searchLocation(title, year)
+        if not location:
+            return False
+
+        movieData, _ = self._getPageData(location)
+        if not movieData:
+            return False
+
+        if self.cache:
+            self.cache.storeLocation(title, year, location)
+        return movieData
+
+    def _searchLocation(self, title, year):
         movies = self._getJson(movieSearch_url, params={'q': title})
 
         if not movies:
@@ -34,42 +61,75 @@ class Apple():
                     location = movie.get('location', None)
                     break
         
-        # check if we found the right movie
-        if not location:
-            return False
+        return location
 
+    def _getPageData(self, location):
         # build and get data for movie
         url = requests.compat.urljoin(moviePage_url, location + '/data/page.json')
         log.debug('Getting movie data from url: {}'.format(url))
-        movieData = self._getJson(url)
-
-        if not movieData:
-            return False
-
-        return movieData
+        return self._fetchJson(url)
 
     def _getJson(self, url, params=None):
+        return self._fetchJson(url, params)[0]
+
+    def _fetchJson(self, url, params=None):
+        '''
+        Returns (result, gone). result is None when nothing could be fetched. gone is True
+        when the url answered 404 or with a body that is not JSON, i.e. retrying will not help.
+        '''
+        url = requests.Request('GET', url, params=params).prepare().url
+        cached = self.cache.getResponse(url) if self.cache else None
+        if cached and cached.fresh:
+            return self._parseJson(url, cached.body), False
+
+        # Revalidate stale responses instead of downloading them again
+        headers = {}
+        if cached and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+
         try:
-            with requests.get(url, params=params, timeout=5) as r:
+            with limits.lookups, self.session.get(url, headers=headers, timeout=5) as r:
+                if r.status_code == 304 and cached:
+                    self.cache.refreshResponse(url)
+                    return self._parseJson(url, cached.body), False
                 r.raise_for_status()
                 result = r.json()
                 result['url'] = r.url
-                return result
+                if self.cache:
+                    self.cache.storeResponse(url, r.text, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+                return result, False
         except ValueError:
             log.debug('Failed to parse data returned from Apple. url: {} response:{}'.format(r.url, r.text))
-            return None
+            return None, True
         except requests.exceptions.Timeout:
             log.warning('Timed out while connecting to {}'.format(url))
-            return None
+            return self._staleJson(url, cached), False
         except requests.exceptions.ConnectionError as e:
             log.warning('Failed to connect to {} Error: {}'.format(url, e))
-            return None
+            return self._staleJson(url, cached), False
         except requests.exceptions.HTTPError as e:
             log.warning('Apple search failed for {} Error: {}'.format(url, e))
-            return None
+            return None, e.response.status_code == 404
         except requests.exceptions.RequestException as e:
             log.warning('Unknown error: {}'.format(e))
+            return None, False
+
+    def _staleJson(self, url, cached):
+        # An outdated body beats none when Apple cannot be reached to revalidate it
+        if not cached:
+            return None
+        log.info('Using the cached response for {} until it can be revalidated'.format(url))
+        return self._parseJson(url, cached.body)
+
+    def _parseJson(self, url, body):
+        try:
+            result = json.loads(body)
+        except ValueError:
             return None
+        result['url'] = url
+        return result
 
     def getLinks(self, title, year):
         links =[]
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import time
+from collections import namedtuple
+from utils import logger
+from utils.database import Database
+
+RETAIN_FACTOR = 4  # Stale responses are kept this many ttls for conditional requests before pruning
+
+CachedResponse = namedtuple('CachedResponse', ['body', 'etag', 'last_modified', 'fresh'])
+
+log = logger.get_log(__name__)
+
+class AppleCache(Database):
+    '''
+    Stores Apple search and page.json responses with their validators, plus the movie page
+    location for every title and year so repeat scans skip the search.
+    Responses older than ttl seconds are revalidated with conditional requests.
+    '''
+    NAME = 'apple_cache'
+    VERSION = 1
+    TABLES = {
+        'apple_responses': '''CREATE TABLE IF NOT EXISTS apple_responses (
+            url TEXT PRIMARY KEY,
+            body TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            fetched REAL NOT NULL)''',
+        'apple_locations': '''CREATE TABLE IF NOT EXISTS apple_locations (
+            key TEXT PRIMARY KEY,
+            location TEXT NOT NULL)'''
+    }
+    COUNTERS = ('hits', 'revalidated', 'misses', 'locationHits', 'locationMisses')
+
+    def __init__(self, path, ttl=604800):
+        super().__init__(path)
+        self.ttl = ttl
+
+    @staticmethod
+    def titleYearKey(title, year):
+        return '{}:{}'.format(title.strip().lower(), year)
+
+    def getResponse(self, url):
+        rows = self.execute('SELECT body, etag, last_modified, fetched FROM apple_responses WHERE url = ?', (url,))
+        if not rows:
+            return None
+        row = rows[0]
+        fresh = time.time() - row['fetched'] <= self.ttl
+        if fresh:
+            self._count('hits')
+            log.debug('Apple cache hit for {}'.format(url))
+        return CachedResponse(row['body'], row['etag'], row['last_modified'], fresh)
+
+    def storeResponse(self, url, body, etag=None, lastModified=None):
+        # Every full response is a miss, whether nothing was cached or the cached body changed
+        self._count('misses')
+        self.execute(
+            'INSERT OR REPLACE INTO apple_responses (url, body, etag, last_modified, fetched) VALUES (?, ?, ?, ?, ?)',
+            (url, body, etag, lastModified, time.time())
+        )
+
+    def refreshResponse(self, url):
+        # The server confirmed the stored body is still current
+        self._count('revalidated')
+        self.execute('UPDATE apple_responses SET fetched = ? WHERE url = ?', (time.time(), url))
+
+    def getLocation(self, title, year):
+        rows = self.execute('SELECT location FROM apple_locations WHERE key = ?', (self.titleYearKey(title, year),))
+        self._count('locationHits' if rows else 'locationMisses')
+        return rows[0]['location'] if rows else None
+
+    def storeLocation(self, title, year, location):
+        self.execute('INSERT OR REPLACE INTO apple_locations (key, location) VALUES (?, ?)', (self.titleYearKey(title, year), location))
+
+    def forgetLocation(self, title, year):
+        self.execute('DELETE FROM apple_locations WHERE key = ?', (self.titleYearKey(title, year),))
+
+    def prune(self):
+        self.execute('DELETE FROM apple_responses WHERE fetched < ?', (time.time() - self.ttl * RETAIN_FACTOR,))
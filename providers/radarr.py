@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import requests
+from collections import namedtuple
+from utils import logger, limits
+
+MOVIE_ENDPOINT = '/api/v3/movie'
+
+RadarrMovie = namedtuple('RadarrMovie', ['path', 'tmdbid', 'imdbid', 'title', 'year'])
+
+log = logger.get_log(__name__)
+
+class Radarr():
+    '''
+    Reads the movie list of a Radarr instance so library scans start with known ids
+    '''
+    def __init__(self, url, api_key, session=None):
+        self.url = (url or '').rstrip('/')
+        self.api_key = api_key
+        self.session = session or requests.Session()
+
+    @property
+    def configured(self):
+        return bool(self.url and self.api_key)
+
+    def getMovies(self):
+        '''
+        Returns a RadarrMovie for every movie Radarr has a file for
+        '''
+        url = self.url + MOVIE_ENDPOINT
+        try:
+            with limits.lookups, self.session.get(url, headers={'X-Api-Key': self.api_key}, timeout=60) as r:
+                r.raise_for_status()
+                movies = r.json()
+        except ValueError:
+            log.warning('Failed to parse the movie list returned from Radarr. url: {}'.format(url))
+            return []
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 401:
+                log.error('Radarr API key was not accepted.')
+            else:
+                log.warning('Radarr returned Error: {}'.format(e))
+            return []
+        except requests.exceptions.RequestException as e:
+            log.warning('Failed to connect to Radarr at {} Error: {}'.format(url, e))
+            return []
+
+        results = []
+        for movie in movies:
+            if not movie.get('hasFile') or not movie.get('path'):
+                continue
+            results.append(RadarrMovie(
+                movie['path'],
+                movie.get('tmdbId') or None,
+                movie.get('imdbId') or None,
+                movie.get('title'),
+                movie.get('year') or None
+            ))
+        log.info('Radarr reported {} of {} movies with files'.format(len(results), len(movies)))
+        return results
@@ -1,21 +1,35 @@
 #!/usr/bin/env python3
 
 import tmdbsimple as tmdb
+from collections import namedtuple
 from requests import HTTPError
 from datetime import datetime
-from utils import logger
+import time
+from utils import logger, limits
+from utils.rateLimiter import parse_retry_after
 
 log = logger.get_log(__name__)
 YOUTUBE_BASE_URL = 'https://www.youtube.com/watch?v='
 VIMEO_BASE_URL = 'https://vimeo.com/'
 TMDB_API = '28c936c57b653df80585b30667c1aa2d'
+MAX_ATTEMPTS = 5
+
+TmdbMovie = namedtuple('TmdbMovie', ['tmdbid', 'imdbid', 'title', 'year', 'videos', 'links'])
 
 class Tmdb(object):
-    def __init__(self, min_resolution, max_resolution, languages, api_key=None):
+    '''
+    Stateless TMDB lookups. Every call returns its own TmdbMovie so a single
+    instance can be shared by any number of threads.
+    '''
+    def __init__(self, min_resolution, max_resolution, languages, api_key=None, cache=None, session=None, limiter=None, index=None):
         self.min_resolution = min_resolution
         self.max_resolution = max_resolution
         self.languages = languages
-        self.data = None
+        self.cache = cache
+        self.limiter = limiter
+        self.index = index
+        if session:
+            tmdb.REQUESTS_SESSION = session
         if not api_key:
             tmdb.API_KEY = TMDB_API
         else:
@@ -25,54 +39,34 @@ class Tmdb(object):
     def hasAPIkey(self):
         return not tmdb.API_KEY == None
 
-    @property
-    def title(self):
-        if not self.data:
-            return None
-
-        if 'original_title' in self.data:
-            return self.data.get('original_title', None)
-        if 'title' in self.data:
-            return self.data.get('title', None)
+    def _parseTitle(self, data):
+        if 'original_title' in data:
+            return data.get('original_title', None)
+        if 'title' in data:
+            return data.get('title', None)
         return None
 
-    @property
-    def year(self):
-        if not self.data:
-            return None
-
-        if 'release_date' in self.data:
+    def _parseYear(self, data):
+        if 'release_date' in data:
             try:
-                year = str(datetime.strptime(self.data['release_date'], '%Y-%m-%d').year)
+                year = str(datetime.strptime(data['release_date'], '%Y-%m-%d').year)
             except:
                 return None
             else:
                 return year
         return None
 
-    @property
-    def videos(self):
-        if self.data and 'videos' in self.data:
-            videos = self.data.get('videos', None)
-            if 'results' in videos:
-                return videos.get('results', None)
-        return None
-
-    @property
-    def has_videos(self):
-        if not self.videos == None:
-            return True
-        return False
+    def _parseVideos(self, data):
+        videos = data.get('videos', None)
+        if videos and 'results' in videos:
+            return tuple(videos.get('results') or ())
+        return ()
 
-    def getLinks(self):
+    def _parseLinks(self, videos):
         links = []
 
-        # return empty list if no movie details or videos exist
-        if not self.data or not self.videos:
-            return links
-
         # Filter videos 
-        for video in self.videos:
+        for video in videos:
             # Filter based on type
             if not video['type'].lower() == 'trailer':
                 log.debug('Filtered based on type. {}'.format(video['name']))
@@ -94,64 +88,84 @@ class Tmdb(object):
                 trailer['url'] = '{}{}'.format(YOUTUBE_BASE_URL, video['key'])
             elif 'vimeo' == video['site'].lower():
                 trailer['url'] = '{}{}'.format(VIMEO_BASE_URL, video['key'])
+            else:
+                continue
             trailer['height'] = int(video['size'])
             trailer['source'] = 'youtube'
 
             links.append(trailer)
-        return links
+        return tuple(links)
 
-    def get_trailer_links(self, languages=None, min_size=0):
-        trailers = []
-        if not self.videos:
-            return trailers
-        for video in self.videos:
-            # Filter based on type
-            if not video['type'].lower() == 'trailer':
-                log.debug('Filtered based on type. {}'.format(video['name']))
-                continue
-
-            # Filter based on size
-            if not int(min_size) < int(video['size']):
-                log.debug('Filtered based on size. {}'.format(video['name']))
+    def _request(self, func, **kwargs):
+        # Every TMDB call goes through the shared limiter. 429 responses pause all callers and are retried
+        for attempt in range(MAX_ATTEMPTS):
+            if self.limiter:
+                self.limiter.acquire()
+            try:
+                with limits.lookups:
+                    result = func(**kwargs)
+            except HTTPError as e:
+                if e.response is None or e.response.status_code != 429 or attempt == MAX_ATTEMPTS - 1:
+                    raise
+                delay = parse_retry_after(e.response.headers.get('Retry-After'), 2 ** attempt)
+                if self.limiter:
+                    self.limiter.backoff(delay)
+                else:
+                    time.sleep(delay)
                 continue
+            if self.limiter:
+                self.limiter.success()
+            return result
 
-            # Filter based on language
-            if languages:
-                if not video['iso_639_1'] in languages:
-                    log.debug('Filtered based on language. {}'.format(video['name']))
-                    continue
-            
-            # Build link
-            if 'youtube' == video['site'].lower():
-                video['link'] = '{}{}'.format(YOUTUBE_BASE_URL, video['key'])
-            elif 'vimeo' == video['site'].lower():
-                video['link'] = '{}{}'.format(VIMEO_BASE_URL, video['key'])
-
-            trailers.append(video)
-        return [x['link'] for x in trailers]
-
-    def get_movie_details(self, tmdbid=None, imdbid=None, title=None, year=None):
+    def lookup(self, tmdbid=None, imdbid=None, title=None, year=None):
         log.debug('Getting data from TMDB')
         if tmdbid:
             log.debug('Searching by TMDBid: {}'.format(tmdbid))
-            movie = self.__get_movie(tmdbid)
         elif imdbid:
             log.debug('Searching by IMDBid: {}'.format(imdbid))
-            movie = self.__get_movie(self.__convert_imdb(imdbid))
+            tmdbid = self.__convert_imdb(imdbid)
         elif title and year:
             log.debug('Searching by Title and Year: {} {}'.format(title, year))
-            movie = self.__get_movie(self.__convert_title_year(title, year))
+            tmdbid = self.__convert_title_year(title, year)
         else:
             log.critical('Not enough info was provided to search TMDB. \n\tTMDBID: {}\n\tIMDBID: {}\n\tTitle: {}\n\tYear:{}'.format(
                 tmdbid, imdbid, title, year
             ))
             return None
-        try:
-            self.data = movie.info(append_to_response='videos')
-        except HTTPError as e:
-            self._handle_error(e)
+
+        if not tmdbid:
+            return None
+
+        data = self.__get_details(tmdbid)
+        if not data:
+            return None
+
+        videos = self._parseVideos(data)
+        return TmdbMovie(
+            data.get('id', tmdbid),
+            data.get('imdb_id', None),
+            self._parseTitle(data),
+            self._parseYear(data),
+            videos,
+            self._parseLinks(videos)
+        )
+
+    def __get_details(self, tmdbid):
+        data = self.cache.getDetails(tmdbid) if self.cache else None
+        if data:
+            return data
+
+        movie = self.__get_movie(tmdbid)
+        if not movie:
             return None
-        return True
+
+        data = self.__get_movie_data(movie)
+        if not data:
+            return None
+
+        if self.cache:
+            self.cache.storeDetails(tmdbid, data)
+        return data
 
     def __get_movie(self, tmdbid):
         try:
@@ -163,7 +177,7 @@ class Tmdb(object):
 
     def __get_movie_data(self, movie):
         try:
-            data = movie.info(append_to_response='videos')
+            data = self._request(movie.info, append_to_response='videos')
         except HTTPError as e:
             self._handle_error(e)
             return None
@@ -171,36 +185,57 @@ class Tmdb(object):
         return data
 
     def __convert_imdb(self, imdbid):
+        if self.cache:
+            tmdb_id = self.cache.getId(self.cache.imdbKey(imdbid))
+            if tmdb_id:
+                return tmdb_id
+
         try:
-            tmdb_id = tmdb.Find(imdbid).info(external_source='imdb_id')['movie_results'][0]['id']
+            tmdb_id = self._request(tmdb.Find(imdbid).info, external_source='imdb_id')['movie_results'][0]['id']
         except HTTPError as e:
             self._handle_error(e)
             return False
         except IndexError:
             log.warning('IMDB id not found: {}'.format(imdbid))
-            self.data = None
             return False
-        
+
+        if self.cache:
+            self.cache.storeId(self.cache.imdbKey(imdbid), tmdb_id)
         return tmdb_id
 
     def __convert_title_year(self, title, year):
+        if self.cache:
+            tmdb_id = self.cache.getId(self.cache.titleYearKey(title, year))
+            if tmdb_id:
+                return tmdb_id
+
+        # The offline index has no years. Confirm against the details, which lookup needs anyway
+        tmdb_id = self.index.find(title) if self.index else None
+        if tmdb_id:
+            data = self.__get_details(tmdb_id)
+            if data and str(self._parseYear(data)) == str(year):
+                log.debug('Resolved "{}" ({}) from the TMDB index'.format(title, year))
+                if self.cache:
+                    self.cache.storeId(self.cache.titleYearKey(title, year), tmdb_id)
+                return tmdb_id
+
         try:
-            response = tmdb.Search().movie(query=title, year=year)
+            response = self._request(tmdb.Search().movie, query=title, year=year)
         except HTTPError as e:
             self._handle_error(e)
             return False
         
         if not response['results'] or len(response['results']) < 1:
-            self.data = None
             return False
 
         for result in response['results']:
             if str(year) in result['release_date'] and result['title'].lower() == title.lower():
+                if self.cache:
+                    self.cache.storeId(self.cache.titleYearKey(title, year), result['id'])
                 return result['id']
 
     def _handle_error(self, error):
         status_code = error.response.status_code
-        self.data = None
         if status_code == 401:
             log.error('TMDB API key was not accepted.')
         elif status_code == 404:
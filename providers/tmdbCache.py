@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import json
+import time
+from utils import logger
+from utils.database import Database
+
+log = logger.get_log(__name__)
+
+class TmdbCache(Database):
+    '''
+    Stores TMDB id resolutions forever and movie details with videos for ttl seconds.
+    Backed by sqlite in WAL mode so several TrailerTech processes can share it.
+    '''
+    NAME = 'tmdb_cache'
+    VERSION = 1
+    TABLES = {
+        'tmdb_ids': '''CREATE TABLE IF NOT EXISTS tmdb_ids (
+            key TEXT PRIMARY KEY,
+            tmdbid INTEGER NOT NULL)''',
+        'tmdb_details': '''CREATE TABLE IF NOT EXISTS tmdb_details (
+            tmdbid INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            fetched REAL NOT NULL)'''
+    }
+    COUNTERS = ('hits', 'misses')
+
+    def __init__(self, path, ttl=604800):
+        super().__init__(path)
+        self.ttl = ttl
+
+    @staticmethod
+    def imdbKey(imdbid):
+        return 'imdb:{}'.format(imdbid.lower())
+
+    @staticmethod
+    def titleYearKey(title, year):
+        return 'title:{}:{}'.format(title.strip().lower(), year)
+
+    def getId(self, key):
+        rows = self.execute('SELECT tmdbid FROM tmdb_ids WHERE key = ?', (key,))
+        self._count('hits' if rows else 'misses')
+        if rows:
+            log.debug('TMDB cache hit for {}'.format(key))
+            return rows[0]['tmdbid']
+        return None
+
+    def storeId(self, key, tmdbid):
+        self.execute('INSERT OR REPLACE INTO tmdb_ids (key, tmdbid) VALUES (?, ?)', (key, int(tmdbid)))
+
+    def getDetails(self, tmdbid):
+        rows = self.execute('SELECT data, fetched FROM tmdb_details WHERE tmdbid = ?', (int(tmdbid),))
+        if not rows or time.time() - rows[0]['fetched'] > self.ttl:
+            self._count('misses')
+            return None
+        try:
+            data = json.loads(rows[0]['data'])
+        except ValueError:
+            self._count('misses')
+            return None
+        self._count('hits')
+        log.debug('TMDB cache hit for details of {}'.format(tmdbid))
+        return data
+
+    def storeDetails(self, tmdbid, data):
+        self.execute(
+            'INSERT OR REPLACE INTO tmdb_details (tmdbid, data, fetched) VALUES (?, ?, ?)',
+            (int(tmdbid), json.dumps(data), time.time())
+        )
+
+    def prune(self):
+        self.execute('DELETE FROM tmdb_details WHERE fetched < ?', (time.time() - self.ttl,))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import re
+import gzip
+import json
+import zlib
+import tempfile
+from datetime import datetime, timedelta, timezone
+import requests
+from unidecode import unidecode
+from utils import logger
+from utils.database import Database
+
+EXPORT_URL = 'http://files.tmdb.org/p/exports/movie_ids_{:%m_%d_%Y}.json.gz'
+BATCH_SIZE = 10000
+CHUNK_SIZE = 1024 * 1024
+STAGING_TABLE = 'tmdb_index_staging'
+INDEX_SCHEMA = '''CREATE TABLE IF NOT EXISTS {} (
+    key TEXT PRIMARY KEY,
+    tmdbid INTEGER NOT NULL,
+    matches INTEGER NOT NULL) WITHOUT ROWID'''
+NON_ALNUM_PATTERN = re.compile(r'[^a-z0-9]+')
+
+log = logger.get_log(__name__)
+
+def normalize_title(title):
+    title = unidecode(title).lower().replace('&', ' and ')
+    title = title.replace("'", '')
+    return NON_ALNUM_PATTERN.sub(' ', title).strip()
+
+def latest_export_url():
+    # Exports are published daily for the previous day
+    return EXPORT_URL.format(datetime.now(timezone.utc) - timedelta(days=1))
+
+class TmdbIndex(Database):
+    '''
+    Offline title to TMDB id index built from the daily movie id export. Exports carry no
+    release year, so only titles shared by a single movie resolve and callers confirm the year.
+    '''
+    NAME = 'tmdb_index'
+    VERSION = 1
+    TABLES = {
+        'tmdb_index': INDEX_SCHEMA.format('tmdb_index')
+    }
+    COUNTERS = ('hits', 'misses')
+
+    def find(self, title):
+        '''
+        Returns the TMDB id of the only movie titled title or None
+        '''
+        key = normalize_title(title)
+        if not key:
+            return None
+        rows = self.execute('SELECT tmdbid, matches FROM tmdb_index WHERE key = ?', (key,))
+        found = bool(rows) and rows[0]['matches'] == 1
+        self._count('hits' if found else 'misses')
+        return rows[0]['tmdbid'] if found else None
+
+    def rebuild(self, source=None, session=None):
+        '''
+        Replaces the index with the entries of a gzipped JSON lines export read from a
+        local path or URL. Defaults to the latest TMDB export.
+        The export is loaded into a staging table that only replaces the index once it
+        loaded completely, so a failed rebuild keeps the previous index.
+        '''
+        source = source or latest_export_url()
+        log.info('Rebuilding TMDB index from {}'.format(source))
+        self.execute('DROP TABLE IF EXISTS {}'.format(STAGING_TABLE))
+        self.execute(INDEX_SCHEMA.format(STAGING_TABLE))
+        count = None
+        rebuilt = False
+        try:
+            if source.lower().startswith(('http://', 'https://')):
+                with self._download(source, session) as downloaded, gzip.GzipFile(fileobj=downloaded) as export:
+                    count = self._load(export)
+            else:
+                with gzip.open(source, 'rb') as export:
+                    count = self._load(export)
+            if count == 0:
+                log.error('TMDB export {} held no movies'.format(source))
+            rebuilt = bool(count) and self._swap()
+        except (requests.exceptions.RequestException, OSError, EOFError, zlib.error) as e:
+            log.error('Failed to rebuild TMDB index from {} ERROR: {}'.format(source, e))
+        finally:
+            # Gone already after a successful swap
+            self.execute('DROP TABLE IF EXISTS {}'.format(STAGING_TABLE))
+
+        if not rebuilt:
+            log.warning('Keeping the previous TMDB index')
+            return False
+        log.info('TMDB index rebuilt with {} movies'.format(count))
+        return True
+
+    def _download(self, url, session=None):
+        # Fetched through iter_content so a cut off transfer raises a RequestException
+        downloaded = tempfile.TemporaryFile()
+        try:
+            with (session or requests.Session()).get(url, stream=True, timeout=30) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    downloaded.write(chunk)
+        except BaseException:
+            downloaded.close()
+            raise
+        downloaded.seek(0)
+        return downloaded
+
+    def _swap(self):
+        return self.transaction([
+            ('DROP TABLE tmdb_index', ()),
+            ('ALTER TABLE {} RENAME TO tmdb_index'.format(STAGING_TABLE), ())
+        ])
+
+    def _load(self, export):
+        # Returns the number of movies loaded into the staging table or None when storing them failed
+        count = 0
+        batch = []
+        for line in export:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('adult') or entry.get('video') or not entry.get('id'):
+                continue
+            key = normalize_title(entry.get('original_title') or '')
+            if not key:
+                continue
+            batch.append((key, int(entry['id'])))
+            count += 1
+            if len(batch) >= BATCH_SIZE:
+                if not self._insert(batch):
+                    return None
+                batch = []
+        if not self._insert(batch):
+            return None
+        return count
+
+    def _insert(self, batch):
+        # Titles shared by several movies are kept with their count so they never resolve
+        return self.executemany(
+            'INSERT INTO {} (key, tmdbid, matches) VALUES (?, ?, 1) '
+            'ON CONFLICT(key) DO UPDATE SET matches = matches + 1'.format(STAGING_TABLE),
+            batch
+        )
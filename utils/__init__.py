@@ -5,6 +5,8 @@ from utils.logger import Logger
 from utils.config import Config
 from utils.environment import Env
 from utils.arguments import get_arguments
+from utils.limits import Limits
+from utils.bandwidth import BandwidthLimiter
 
 __appName__ = 'TrailerTech'
 __author__ = 'JsAddiction'
@@ -13,7 +15,21 @@ __description__ = 'Download Trailers for your movie library.'
 
 CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'settings.ini')
 LOG_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'TrailerTech.log')
+DB_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'TrailerTech.db')
 env = Env()
 args = get_arguments(__appName__, __description__, __version__)
 config = Config(CONFIG_PATH)
 logger = Logger(LOG_PATH, config.log_level, config.log_to_file, quiet=args.quiet)
+limits = Limits(
+    args.maxProbes if args.maxProbes is not None else config.max_probes,
+    args.maxLookups if args.maxLookups is not None else config.max_lookups,
+    args.maxDownloads if args.maxDownloads is not None else config.max_downloads
+)
+try:
+    bandwidth = BandwidthLimiter(
+        args.maxBandwidth if args.maxBandwidth is not None else config.bandwidth_limit,
+        config.bandwidth_schedule if args.maxBandwidth is None else None
+    )
+except ValueError as e:
+    logger.get_log(__name__).error('{}. Downloads are not throttled.'.format(e))
+    bandwidth = BandwidthLimiter()
@@ -10,8 +10,23 @@ def get_arguments(name, description, version):
     parser.add_argument('-r', '--recursive', action='store_true', dest='recursive', help='Scan all directories within the path given', default=False)
     parser.add_argument('-q', '--quiet', action='store_true', dest='quiet', help='Only log results of scan and critical errors to screen. (useful for cron jobs)', default=False)
     parser.add_argument('-d', '--directory', metavar='directory', dest='directory', help='Directory to scan. Use -r flag to scan entire library.', default=None)
+    parser.add_argument('--radarr', action='store_true', dest='radarr', help='Scan the movies known to Radarr (settings.ini [RADARR]) instead of a directory', default=False)
     parser.add_argument('--use_threads', action='store_true', dest='threads', help='Speed up scans with threading', default=False)
+    parser.add_argument('--pipeline', action='store_true', dest='pipeline', help='Scan, look up and download concurrently in separate stages (recursive mode)', default=False)
     parser.add_argument('--delete_corrupt', action='store_true', dest='deleteCorrupt', help='Remove trailers with corruption and replace', default=False)
+    parser.add_argument('--watch', action='store_true', dest='watch', help='Keep running and get trailers for movie directories as they are added or changed', default=False)
+    parser.add_argument('--poll', action='store_true', dest='poll', help='Use polling instead of inotify in watch mode (network mounts)', default=False)
+    parser.add_argument('--full', action='store_true', dest='full', help='Rescan every directory, even those unchanged since a trailer was found', default=False)
+    parser.add_argument('--recheck', action='store_true', dest='recheck', help='Look for trailers again for movies that recently had none (use with a single movie directory to recheck one title)', default=False)
+    parser.add_argument('--rebuild_tmdb_index', metavar='export', nargs='?', const='', dest='rebuildTmdbIndex', help='Rebuild the offline TMDB title index from a movie id export (path or URL, defaults to the latest TMDB export)', default=None)
+    parser.add_argument('--rebuild_probe_cache', action='store_true', dest='rebuildProbeCache', help='Discard cached ffprobe results and probe every video again', default=False)
+
+    # Create a group for concurrency limits
+    limits_group = parser.add_argument_group('Concurrency limits (override settings.ini, 0 = unlimited)')
+    limits_group.add_argument('--max_probes', metavar='N', dest='maxProbes', help='Simultaneous ffprobe processes', type=int, default=None)
+    limits_group.add_argument('--max_lookups', metavar='N', dest='maxLookups', help='Simultaneous TMDB and Apple requests', type=int, default=None)
+    limits_group.add_argument('--max_downloads', metavar='N', dest='maxDownloads', help='Simultaneous trailer downloads', type=int, default=None)
+    limits_group.add_argument('--max_bandwidth', metavar='RATE', dest='maxBandwidth', help='Download bandwidth shared by all downloads in bytes/sec. K and M suffixes are allowed', default=None)
 
     # Create argument groups
     title_year_group = parser.add_argument_group('Movie Title Year info')
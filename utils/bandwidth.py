@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import re
+import time
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+RATE_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*$', re.IGNORECASE)
+WINDOW_PATTERN = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(.+)$')
+UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+BURST_SECONDS = 1  # How far a stream may run ahead of its share after being idle
+
+def parse_rate(value):
+    '''
+    Returns bytes per second from values like "500000", "512K" or "2M". 0 means unlimited
+    '''
+    if value is None or str(value).strip() == '':
+        return 0
+    match = RATE_PATTERN.match(str(value))
+    if not match:
+        raise ValueError('Invalid bandwidth "{}"'.format(value))
+    return int(float(match.group(1)) * UNITS[match.group(2).lower()])
+
+def parse_schedule(value):
+    '''
+    Returns [(startMinute, endMinute, rate)] from "HH:MM-HH:MM=RATE" windows separated by commas.
+    Windows ending before they start wrap past midnight.
+    '''
+    windows = []
+    for entry in (value or '').split(','):
+        if not entry.strip():
+            continue
+        match = WINDOW_PATTERN.match(entry)
+        if not match:
+            raise ValueError('Invalid bandwidth schedule entry "{}"'.format(entry.strip()))
+        startHour, startMinute, endHour, endMinute, rate = match.groups()
+        windows.append((int(startHour) * 60 + int(startMinute), int(endHour) * 60 + int(endMinute), parse_rate(rate)))
+    return windows
+
+class BandwidthLimiter():
+    '''
+    Process wide download bandwidth budget. The rate in effect is split evenly between the
+    downloads registered with stream(). A rate of 0 means unlimited.
+    '''
+    def __init__(self, rate=0, schedule=None):
+        self.rate = parse_rate(rate)
+        self.schedule = parse_schedule(schedule)
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def currentRate(self, now=None):
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+                return rate
+        return self.rate
+
+    @property
+    def enabled(self):
+        return bool(self.rate or any(rate for _, _, rate in self.schedule))
+
+    def share(self):
+        '''
+        Returns the bytes per second each active download may use. 0 means unlimited
+        '''
+        rate = self.currentRate()
+        with self._lock:
+            return rate / max(self.active, 1)
+
+    @contextmanager
+    def stream(self):
+        with self._lock:
+            self.active += 1
+        try:
+            yield _Stream(self)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def __str__(self):
+        if not self.enabled:
+            return 'unlimited'
+        return '{}/s{}'.format(self.rate or 'unlimited', ' (scheduled)' if self.schedule else '')
+
+class _Stream():
+    '''
+    Paces a single download to its share of the budget. Safe to use from several threads
+    '''
+    def __init__(self, limiter):
+        self._limiter = limiter
+        self._tokens = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def throttle(self, size):
+        rate = self._limiter.share()
+        if rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(rate * BURST_SECONDS, self._tokens + (now - self._updated) * rate) - size
+            self._updated = now
+            wait = -self._tokens / rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
@@ -50,6 +50,20 @@ class Config(object):
                 return self._raw_config['TMDB'].get('api_key', None)
         return None
 
+    @property
+    def tmdb_cache_ttl(self):
+        if not self._raw_config is None:
+            if 'TMDB' in self._raw_config.sections():
+                return self._raw_config['TMDB'].getint('cache_ttl', 7)
+        return 7
+
+    @property
+    def tmdb_rate_limit(self):
+        if not self._raw_config is None:
+            if 'TMDB' in self._raw_config.sections():
+                return self._raw_config['TMDB'].getfloat('rate_limit', 40)
+        return 40
+
     @property
     def languages(self):
         if not self._raw_config is None:
@@ -88,9 +102,164 @@ class Config(object):
                 return self._raw_config['APPLE'].getboolean('enabled', True)
         return True
 
+    @property
+    def apple_cache_ttl(self):
+        if not self._raw_config is None:
+            if 'APPLE' in self._raw_config.sections():
+                return self._raw_config['APPLE'].getint('cache_ttl', 7)
+        return 7
+
     @property
     def perferred_source(self):
         if not self._raw_config is None:
             if 'TRAILERS' in self._raw_config.sections():
                 return self._raw_config['TRAILERS'].get('perferred_source', 'apple').lower()
-        return 'apple'
\ No newline at end of file
+        return 'apple'
+
+    @property
+    def probe_cache_size(self):
+        if not self._raw_config is None:
+            if 'CACHE' in self._raw_config.sections():
+                return self._raw_config['CACHE'].getint('probe_cache_size', 50000)
+        return 50000
+
+    @property
+    def nfo_cache_size(self):
+        if not self._raw_config is None:
+            if 'CACHE' in self._raw_config.sections():
+                return self._raw_config['CACHE'].getint('nfo_cache_size', 50000)
+        return 50000
+
+    @property
+    def watch_debounce(self):
+        if not self._raw_config is None:
+            if 'WATCH' in self._raw_config.sections():
+                return self._raw_config['WATCH'].getint('debounce', 30)
+        return 30
+
+    @property
+    def watch_poll_interval(self):
+        if not self._raw_config is None:
+            if 'WATCH' in self._raw_config.sections():
+                return self._raw_config['WATCH'].getint('poll_interval', 60)
+        return 60
+
+    @property
+    def watch_use_polling(self):
+        if not self._raw_config is None:
+            if 'WATCH' in self._raw_config.sections():
+                return self._raw_config['WATCH'].getboolean('use_polling', False)
+        return False
+
+    @property
+    def pool_size(self):
+        default = min(32, (os.cpu_count() or 1) + 4)
+        if not self._raw_config is None:
+            if 'NETWORK' in self._raw_config.sections():
+                return self._raw_config['NETWORK'].getint('pool_size', default)
+        return default
+
+    @property
+    def retries(self):
+        if not self._raw_config is None:
+            if 'NETWORK' in self._raw_config.sections():
+                return self._raw_config['NETWORK'].getint('retries', 3)
+        return 3
+
+    @property
+    def retry_backoff(self):
+        if not self._raw_config is None:
+            if 'NETWORK' in self._raw_config.sections():
+                return self._raw_config['NETWORK'].getfloat('retry_backoff', 0.5)
+        return 0.5
+
+    @property
+    def max_probes(self):
+        if not self._raw_config is None:
+            if 'CONCURRENCY' in self._raw_config.sections():
+                return self._raw_config['CONCURRENCY'].getint('probes', 4)
+        return 4
+
+    @property
+    def max_lookups(self):
+        if not self._raw_config is None:
+            if 'CONCURRENCY' in self._raw_config.sections():
+                return self._raw_config['CONCURRENCY'].getint('lookups', 8)
+        return 8
+
+    @property
+    def max_downloads(self):
+        if not self._raw_config is None:
+            if 'CONCURRENCY' in self._raw_config.sections():
+                return self._raw_config['CONCURRENCY'].getint('downloads', 2)
+        return 2
+
+    @property
+    def download_segments(self):
+        if not self._raw_config is None:
+            if 'DOWNLOADS' in self._raw_config.sections():
+                return self._raw_config['DOWNLOADS'].getint('segments', 1)
+        return 1
+
+    @property
+    def validate_links(self):
+        if not self._raw_config is None:
+            if 'DOWNLOADS' in self._raw_config.sections():
+                return self._raw_config['DOWNLOADS'].getint('validate_links', 3)
+        return 3
+
+    @property
+    def bandwidth_limit(self):
+        if not self._raw_config is None:
+            if 'BANDWIDTH' in self._raw_config.sections():
+                return self._raw_config['BANDWIDTH'].get('limit', '0')
+        return '0'
+
+    @property
+    def bandwidth_schedule(self):
+        if not self._raw_config is None:
+            if 'BANDWIDTH' in self._raw_config.sections():
+                return self._raw_config['BANDWIDTH'].get('schedule', '')
+        return ''
+
+    @property
+    def radarr_url(self):
+        if not self._raw_config is None:
+            if 'RADARR' in self._raw_config.sections():
+                return self._raw_config['RADARR'].get('url', None)
+        return None
+
+    @property
+    def radarr_api_key(self):
+        if not self._raw_config is None:
+            if 'RADARR' in self._raw_config.sections():
+                return self._raw_config['RADARR'].get('api_key', None)
+        return None
+
+    @property
+    def library_max_depth(self):
+        if not self._raw_config is None:
+            if 'LIBRARY' in self._raw_config.sections():
+                return self._raw_config['LIBRARY'].getint('max_depth', 3)
+        return 3
+
+    @property
+    def library_exclude(self):
+        if not self._raw_config is None:
+            if 'LIBRARY' in self._raw_config.sections():
+                return self._raw_config['LIBRARY'].get('exclude', '').split(',')
+        return []
+
+    @property
+    def write_sidecar(self):
+        if not self._raw_config is None:
+            if 'METADATA' in self._raw_config.sections():
+                return self._raw_config['METADATA'].getboolean('write_sidecar', False)
+        return False
+
+    @property
+    def write_nfo_ids(self):
+        if not self._raw_config is None:
+            if 'METADATA' in self._raw_config.sections():
+                return self._raw_config['METADATA'].getboolean('write_nfo_ids', False)
+        return False
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import time
+import sqlite3
+import threading
+from utils import logger
+
+TOUCH_INTERVAL = 86400  # In seconds. How stale last_used may get before a hit refreshes it
+
+log = logger.get_log(__name__)
+
+class Database():
+    '''
+    Thread safe wrapper around the sqlite database shared by the various caches.
+    Subclasses set NAME, VERSION and TABLES. Tables are dropped and recreated
+    whenever the stored VERSION for NAME differs. Every name in COUNTERS becomes
+    a statistic attribute starting at 0 that _count increments.
+    '''
+    NAME = None
+    VERSION = 1
+    TABLES = {}
+    COUNTERS = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = None
+        self._statsLock = threading.Lock()
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+        try:
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._createTables()
+        except sqlite3.Error as e:
+            log.warning('Unable to open database {} for {}. Caching disabled. ERROR: {}'.format(path, self.NAME, e))
+            self._conn = None
+
+    @property
+    def enabled(self):
+        return not self._conn is None
+
+    def _count(self, counter):
+        with self._statsLock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _createTables(self):
+        self._conn.execute('CREATE TABLE IF NOT EXISTS schema_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+        row = self._conn.execute('SELECT version FROM schema_versions WHERE name = ?', (self.NAME,)).fetchone()
+        if row and row['version'] != self.VERSION:
+            log.info('Upgrading {} from version {} to {}. Existing entries are discarded.'.format(self.NAME, row['version'], self.VERSION))
+            for table in self.TABLES:
+                self._conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+        for statement in self.TABLES.values():
+            self._conn.execute(statement)
+        self._conn.execute('INSERT OR REPLACE INTO schema_versions (name, version) VALUES (?, ?)', (self.NAME, self.VERSION))
+
+    def execute(self, sql, params=()):
+        if not self.enabled:
+            return []
+        with self._lock:
+            try:
+                return self._conn.execute(sql, params).fetchall()
+            except sqlite3.Error as e:
+                log.warning('{} query failed. ERROR: {}'.format(self.NAME, e))
+                return []
+
+    def executemany(self, sql, seq):
+        if not self.enabled:
+            return False
+        with self._lock:
+            try:
+                self._conn.execute('BEGIN')
+                self._conn.executemany(sql, seq)
+                self._conn.execute('COMMIT')
+                return True
+            except sqlite3.Error as e:
+                log.warning('{} query failed. ERROR: {}'.format(self.NAME, e))
+                if self._conn.in_transaction:
+                    self._conn.execute('ROLLBACK')
+                return False
+
+    def transaction(self, statements):
+        '''
+        Runs (sql, params) pairs in a single transaction. Returns False after rolling
+        everything back when any of them fails.
+        '''
+        if not self.enabled:
+            return False
+        with self._lock:
+            try:
+                self._conn.execute('BEGIN')
+                for sql, params in statements:
+                    self._conn.execute(sql, params)
+                self._conn.execute('COMMIT')
+                return True
+            except sqlite3.Error as e:
+                log.warning('{} query failed. ERROR: {}'.format(self.NAME, e))
+                if self._conn.in_transaction:
+                    self._conn.execute('ROLLBACK')
+                return False
+
+    def close(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._conn.close()
+            self._conn = None
+
+class FileCache(Database):
+    '''
+    Database of results derived from files, keyed by path and only valid for the size and
+    mtime they were stored with. Subclasses set TABLE, which needs path, size, mtime and
+    last_used columns. Beyond maxEntries, the rows unused the longest are pruned.
+    '''
+    TABLE = None
+    COUNTERS = ('hits', 'misses')
+
+    def __init__(self, path, maxEntries=50000):
+        super().__init__(path)
+        self.maxEntries = int(maxEntries)
+
+    def _getRow(self, path, size, mtime):
+        # Returns the row stored for path while size and mtime still match. Stale rows are dropped
+        rows = self.execute('SELECT * FROM {} WHERE path = ?'.format(self.TABLE), (path,))
+        if not rows:
+            return None
+
+        row = rows[0]
+        if row['size'] != size or row['mtime'] != mtime:
+            log.debug('{} entry is stale: {}'.format(self.NAME, path))
+            self.invalidate(path)
+            return None
+
+        if time.time() - row['last_used'] > TOUCH_INTERVAL:
+            self.execute('UPDATE {} SET last_used = ? WHERE path = ?'.format(self.TABLE), (time.time(), path))
+        return row
+
+    def invalidate(self, path):
+        self.execute('DELETE FROM {} WHERE path = ?'.format(self.TABLE), (path,))
+
+    def prune(self):
+        # Entries for deleted or replaced files stop being used and age out here
+        self.execute(
+            'DELETE FROM {0} WHERE path NOT IN (SELECT path FROM {0} ORDER BY last_used DESC LIMIT ?)'.format(self.TABLE),
+            (self.maxEntries,)
+        )
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils import logger
+
+RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+log = logger.get_log(__name__)
+
+class KeepAliveSession(requests.Session):
+    '''
+    Session that never lets callers turn off keep-alive. tmdbsimple sends "Connection: close"
+    with every request, which would open a new connection for each TMDB call.
+    '''
+    def request(self, method, url, **kwargs):
+        headers = kwargs.get('headers')
+        if headers:
+            kwargs['headers'] = {key: value for key, value in headers.items() if key.lower() != 'connection'}
+        return super().request(method, url, **kwargs)
+
+def create_session(poolSize=10, retries=3, backoff=0.5):
+    '''
+    Returns a requests session with keep-alive connection pools of poolSize per host
+    that retries connect, read and server errors with exponential backoff
+    '''
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=['GET', 'HEAD'],
+        raise_on_status=False,
+        # 429s must reach the callers so the shared rate limiter can pause everyone
+        respect_retry_after_header=False
+    )
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=retry)
+    session = KeepAliveSession()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    log.debug('Created HTTP session. Pool size: {} Retries: {} Backoff: {}'.format(poolSize, retries, backoff))
+    return session
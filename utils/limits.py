@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import threading
+from contextlib import nullcontext
+
+class Limits():
+    '''
+    Process wide concurrency limits for ffprobe subprocesses, metadata requests and downloads.
+    A limit of 0 or less means unlimited.
+    '''
+    def __init__(self, probes, lookups, downloads):
+        self.maxProbes = int(probes)
+        self.maxLookups = int(lookups)
+        self.maxDownloads = int(downloads)
+        self.probes = self._semaphore(self.maxProbes)
+        self.lookups = self._semaphore(self.maxLookups)
+        self.downloads = self._semaphore(self.maxDownloads)
+
+    def _semaphore(self, limit):
+        if limit > 0:
+            return threading.BoundedSemaphore(limit)
+        return nullcontext()
+
+    def acquireDownloads(self, count):
+        '''
+        Takes up to count extra download slots without blocking and returns how many were taken
+        '''
+        if self.maxDownloads <= 0:
+            return count
+        acquired = 0
+        while acquired < count and self.downloads.acquire(blocking=False):
+            acquired += 1
+        return acquired
+
+    def releaseDownloads(self, count):
+        if self.maxDownloads <= 0:
+            return
+        for _ in range(count):
+            self.downloads.release()
+
+    def __str__(self):
+        return '{}/{}/{}'.format(*[limit if limit > 0 else 'unlimited' for limit in (self.maxProbes, self.maxLookups, self.maxDownloads)])
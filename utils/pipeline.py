@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import asyncio
+import concurrent.futures
+from utils import logger
+
+_STOP = object()
+
+log = logger.get_log(__name__)
+
+class Stage():
+    '''
+    One step of a Pipeline. func is a blocking callable taking an item and returning
+    the item for the next stage, or None when the item is finished.
+    '''
+    def __init__(self, name, func, concurrency=1):
+        self.name = name
+        self.func = func
+        self.concurrency = max(int(concurrency), 1)
+
+class Pipeline():
+    '''
+    Runs items through stages connected by bounded queues. Each stage has its own
+    worker count and thread pool, so slow stages never hold up earlier ones beyond
+    what the queues allow.
+    '''
+    def __init__(self, stages, queueSize=50):
+        self.stages = stages
+        self.queueSize = queueSize
+
+    def run(self, items):
+        asyncio.run(self._run(iter(items)))
+
+    async def _run(self, items):
+        loop = asyncio.get_running_loop()
+        queues = [asyncio.Queue(maxsize=self.queueSize) for _ in self.stages]
+        executors = [concurrent.futures.ThreadPoolExecutor(max_workers=stage.concurrency, thread_name_prefix=stage.name) for stage in self.stages]
+        feeder = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='discover')
+
+        async def feed():
+            # Discovery runs in its own thread so slow directory listings overlap the other stages
+            try:
+                while True:
+                    item = await loop.run_in_executor(feeder, next, items, _STOP)
+                    if item is _STOP:
+                        break
+                    await queues[0].put(item)
+            except Exception as e:
+                log.error('Pipeline discovery failed. ERROR: {}'.format(e), exc_info=True)
+            finally:
+                for _ in range(self.stages[0].concurrency):
+                    await queues[0].put(_STOP)
+
+        async def work(index):
+            stage = self.stages[index]
+            nextQueue = queues[index + 1] if index + 1 < len(queues) else None
+            while True:
+                item = await queues[index].get()
+                if item is _STOP:
+                    return
+                try:
+                    result = await loop.run_in_executor(executors[index], stage.func, item)
+                except Exception as e:
+                    log.error('Pipeline stage "{}" failed. ERROR: {}'.format(stage.name, e), exc_info=True)
+                    continue
+                if not result is None and nextQueue:
+                    await nextQueue.put(result)
+
+        async def runStage(index):
+            await asyncio.gather(*[work(index) for _ in range(self.stages[index].concurrency)])
+            if index + 1 < len(self.stages):
+                for _ in range(self.stages[index + 1].concurrency):
+                    await queues[index + 1].put(_STOP)
+
+        try:
+            await asyncio.gather(feed(), *[runStage(index) for index in range(len(self.stages))])
+        finally:
+            feeder.shutdown(wait=True)
+            for executor in executors:
+                executor.shutdown(wait=True)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+from email.utils import parsedate_to_datetime
+from utils import logger
+
+MIN_RATE_FACTOR = 0.1  # The adaptive rate never drops below this fraction of the configured rate
+RECOVERY_FACTOR = 1.05  # Rate growth after every successful request following a backoff
+
+log = logger.get_log(__name__)
+
+def parse_retry_after(value, default):
+    '''
+    Returns the delay in seconds from a Retry-After header holding seconds or an HTTP date
+    '''
+    if not value:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return default
+
+class RateLimiter():
+    '''
+    Process wide token bucket. acquire() blocks until a request may be sent.
+    backoff() pauses every caller and lowers the rate, success() lets it recover.
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.currentRate = self.rate
+        self.throttled = 0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._pausedUntil = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._pausedUntil:
+                    wait = self._pausedUntil - now
+                elif self.rate <= 0:
+                    return
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.currentRate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.currentRate
+            time.sleep(wait)
+
+    def backoff(self, delay):
+        with self._lock:
+            self.throttled += 1
+            self._pausedUntil = max(self._pausedUntil, time.monotonic() + delay)
+            self.currentRate = max(self.currentRate / 2, self.rate * MIN_RATE_FACTOR)
+            self._tokens = 0
+            self._updated = self._pausedUntil
+        log.warning('Rate limited. Pausing requests for {:.1f}s and lowering rate to {:.1f}/s'.format(delay, self.currentRate))
+
+    def success(self):
+        if self.currentRate < self.rate:
+            with self._lock:
+                self.currentRate = min(self.rate, self.currentRate * RECOVERY_FACTOR)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from utils import logger
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+log = logger.get_log(__name__)
+
+class InotifyWatcher():
+    '''
+    Reports directories below root that changed using linux inotify. Every folder the walker
+    lists is watched, so movie folders inside collections or A-Z buckets are covered too.
+    Raises OSError when inotify is unavailable so callers can fall back to polling.
+    '''
+    def __init__(self, root, walker):
+        self.root = os.path.abspath(root)
+        self.walker = walker
+        self._watches = {}
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported on this platform')
+
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        try:
+            self._watchTree(self.root)
+        except OSError:
+            self.close()
+            raise
+        log.info('Watching {} directories with inotify.'.format(len(self._watches)))
+
+    def _addWatch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, 'inotify watch limit reached. Raise fs.inotify.max_user_watches or use polling')
+            log.warning('Failed to watch {} ERROR: {}'.format(path, os.strerror(err)))
+            return
+        self._watches[wd] = path
+
+    def _watchTree(self, top):
+        # Returns whether top is part of the watched tree
+        watched = False
+        for path in self.walker.directories(self.root, top):
+            self._addWatch(path)
+            watched = True
+        return watched
+
+    def _unwatchTree(self, top):
+        # A directory moved away keeps its watches. Drop them so events never map to a stale path
+        prefix = top + os.sep
+        for wd, path in list(self._watches.items()):
+            if path == top or path.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+
+    def poll(self, timeout):
+        changed = set()
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return changed
+
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # The lost events may include whole imports. Watch any folders they created and rescan everything
+                log.warning('inotify queue overflowed. Rescanning {}'.format(self.root))
+                try:
+                    self._watchTree(self.root)
+                except OSError as e:
+                    log.warning('Failed to watch {} ERROR: {}'.format(self.root, e))
+                changed.add(self.root)
+                continue
+
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                continue
+
+            if name and mask & IN_ISDIR:
+                path = os.path.join(directory, os.fsdecode(name))
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # New folders may already hold nested ones, e.g. a collection moved in whole
+                    try:
+                        if self._watchTree(path):
+                            changed.add(path)
+                    except OSError as e:
+                        log.warning('Failed to watch {} ERROR: {}'.format(path, e))
+                elif mask & IN_MOVED_FROM:
+                    self._unwatchTree(path)
+
+            # Files directly inside root belong to no movie
+            if directory != self.root:
+                changed.add(directory)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+class PollingWatcher():
+    '''
+    Reports directories below root that changed by comparing the mtimes of every folder the
+    walker lists. Works on network mounts where inotify never fires.
+    '''
+    def __init__(self, root, interval, walker):
+        self.root = os.path.abspath(root)
+        self.interval = interval
+        self.walker = walker
+        self._lastPoll = time.monotonic()
+        self._snapshot = self._takeSnapshot()
+        log.info('Polling {} directories every {}s.'.format(len(self._snapshot), interval))
+
+    def _takeSnapshot(self):
+        snapshot = {}
+        try:
+            os.stat(self.root)
+        except OSError as e:
+            log.warning('Failed to poll {} ERROR: {}'.format(self.root, e))
+            return self._snapshot
+        for path in self.walker.directories(self.root):
+            if path == self.root:
+                continue
+            try:
+                snapshot[path] = os.stat(path).st_mtime
+            except OSError:
+                continue
+        return snapshot
+
+    def poll(self, timeout):
+        remaining = self.interval - (time.monotonic() - self._lastPoll)
+        if remaining > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(remaining, 0))
+        self._lastPoll = time.monotonic()
+
+        snapshot = self._takeSnapshot()
+        changed = {path for path, mtime in snapshot.items() if self._snapshot.get(path) != mtime}
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+class LibraryWatcher():
+    '''
+    Feeds changed directories to a callback once they stop changing for debounce seconds
+    '''
+    def __init__(self, root, walker, debounce=30, pollInterval=60, usePolling=False):
+        self.root = os.path.abspath(root)
+        self.debounce = debounce
+        self._pending = {}
+        self._watcher = None
+        if not usePolling:
+            try:
+                self._watcher = InotifyWatcher(self.root, walker)
+            except OSError as e:
+                log.warning('inotify unavailable, falling back to polling. ERROR: {}'.format(e))
+        if not self._watcher:
+            self._watcher = PollingWatcher(self.root, pollInterval, walker)
+
+    def run(self, callback):
+        try:
+            while True:
+                if self._pending:
+                    timeout = max(min(self._pending.values()) + self.debounce - time.monotonic(), 0)
+                else:
+                    timeout = self.debounce
+
+                changed = self._watcher.poll(timeout)
+                now = time.monotonic()
+                for path in changed:
+                    log.debug('Change detected in {}'.format(path))
+                    self._pending[path] = now
+
+                settled = [path for path, lastEvent in self._pending.items() if now - lastEvent >= self.debounce]
+                for path in settled:
+                    del self._pending[path]
+                    if os.path.isdir(path):
+                        callback(path)
+        finally:
+            self._watcher.close()